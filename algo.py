@@ -1,7 +1,10 @@
 from random import (choice, random, randint)
+import string
+import numpy as np
+import metrics
 import view
 
-__all__ = ['Chromosome', 'Population']
+__all__ = ['Chromosome', 'Population', 'ArrayPopulation']
 
 class Chromosome:
     """
@@ -20,7 +23,7 @@ class Chromosome:
     def __init__(self, gene):
         self.gene = gene
         self.fitness = 0
-        self.name = self.get_name
+        self.name = Chromosome.get_name()
 
     def mate(self, mate):
         """
@@ -76,8 +79,9 @@ class Chromosome:
 
         return gene
 
+    @staticmethod
     def get_name():
-        return ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(10))
+        return ''.join(choice(string.ascii_uppercase + string.digits) for _ in range(10))
 
 class Population:
     """
@@ -121,10 +125,46 @@ class Population:
 
         return (self._tournament_selection(), self._tournament_selection())
 
+    def breed(self):
+        """
+        Method to produce a single child for steady-state evolution: the
+        crossover of two tournament selected parents, or a copy of one, that
+        may then be mutated.
+        """
+        if random() <= self.crossover:
+            (p1, p2) = self._selectParents()
+            child = choice(p1.mate(p2))
+        else:
+            child = Chromosome(list(self._tournament_selection().gene))
+        if random() <= self.mutation:
+            child = child.mutate()
+        return child
+
+    def insert(self, chromosome, size=None):
+        """
+        Method to add an evaluated chromosome to the population, keeping it
+        sorted. Once the population holds size chromosomes (its current size
+        by default), the chromosome replaces the worst one if it is at least
+        as fit, otherwise it is dropped. Return whether it was inserted.
+        """
+        if size is None:
+            size = len(self.population)
+        if len(self.population) >= size:
+            if chromosome.fitness < self.population[0].fitness:
+                return False
+            self.population = self.population[1:]
+        self.population = list(sorted(self.population + [chromosome],
+                                      key=lambda x: x.fitness))
+        return True
+
     def evolve(self):
         """
         Method to evolve the population of chromosomes.
         """
+        with metrics.timer('population.evolve'):
+            self._evolve()
+
+    def _evolve(self):
         size = len(self.population)
         idx = int(round(size * self.elitism))
         buf = self.population[:idx]
@@ -148,6 +188,94 @@ class Population:
 
         self.population = list(sorted(buf[:size], key=lambda x: x.fitness))
 
+class ArrayPopulation:
+    """
+    Array based alternative to Population for very large populations.
+    The genes of all individuals are the rows of a single (N, G) matrix and
+    their fitnesses a vector, both sorted by fitness like Population. Tournament
+    selection, one-point crossover and mutation of a whole generation are done
+    as a few batched numpy operations drawn from a seeded Generator, so the
+    bookkeeping stays negligible next to the simulation. Unlike Population,
+    the elites kept unchanged are the fittest individuals (end of the arrays).
+    """
+
+    _tournamentSize = 3
+
+    def __init__(self, size=2084, crossover=0.8, elitism=0.1, mutation=0.03,
+                 seed=None):
+        self.elitism = elitism
+        self.mutation = mutation
+        self.crossover = crossover
+        self.rng = np.random.default_rng(seed)
+
+        low, high = np.array(Chromosome.gene_range).T
+        self.genes = self.rng.integers(low, high, endpoint=True,
+                                       size=(size, len(low))) / 50.0
+        self.fitness = np.zeros(size)
+
+    def __len__(self):
+        return len(self.genes)
+
+    def sort(self):
+        """
+        Sort genes by fitness, fittest last
+        """
+        order = np.argsort(self.fitness, kind='stable')
+        self.genes = self.genes[order]
+        self.fitness = self.fitness[order]
+
+    def _tournament_selection(self, n):
+        """
+        Select n individuals, each the fittest of a tournament of
+        _tournamentSize + 1 random contestants. Return their indices.
+        """
+        size = len(self.genes)
+        contestants = self.rng.integers(
+                size, size=(n, ArrayPopulation._tournamentSize + 1))
+        winners = np.argmax(self.fitness[contestants], axis=1)
+        return contestants[np.arange(n), winners]
+
+    def evolve(self):
+        """
+        Method to evolve the population, all at once.
+        """
+        with metrics.timer('population.evolve'):
+            self._evolve()
+
+    def _evolve(self):
+        self.sort()
+        size, n_genes = self.genes.shape
+        n_elite = int(round(size * self.elitism))
+        n_children = size - n_elite
+        n_pairs = (n_children + 1) // 2
+        # without crossover individuals pass through unchanged
+        children = np.resize(self.genes, (2*n_pairs, n_genes))
+
+        # one-point crossover of tournament selected parents
+        mated = self.rng.random(n_pairs) <= self.crossover
+        n_mated = np.count_nonzero(mated)
+        parents1 = self.genes[self._tournament_selection(n_mated)]
+        parents2 = self.genes[self._tournament_selection(n_mated)]
+        pivots = self.rng.integers(n_genes, size=n_mated)
+        first = np.arange(n_genes) < pivots[:, None]
+        pairs = children.reshape(n_pairs, 2, n_genes)
+        pairs[mated, 0] = np.where(first, parents1, parents2)
+        pairs[mated, 1] = np.where(first, parents2, parents1)
+        children = children[:n_children]
+
+        # mutation of one gene by at most half its value
+        mutants = np.flatnonzero(self.rng.random(n_children) <= self.mutation)
+        idx = self.rng.integers(n_genes, size=len(mutants))
+        values = children[mutants, idx]
+        half = np.trunc(values / 2)
+        delta = np.floor(self.rng.random(len(mutants)) * (2*half + 1)) - half
+        children[mutants, idx] = values + delta
+
+        self.genes = np.concatenate([children, self.genes[size - n_elite:]])
+        self.fitness = np.concatenate([np.zeros(n_children),
+                                       self.fitness[size - n_elite:]])
+        self.sort()
+
 """
 if __name__ == "__main__":
     maxGenerations = 16384
@@ -0,0 +1,247 @@
+"""
+Benchmarks of the simulate - evaluate - evolve pipeline.
+Every benchmark is timed over a few repeats and the results are printed (or
+written with --output) as JSON, tagged with the current git commit, so runs on
+different commits can be compared to catch regressions.
+Run as "python bench.py [--quick] [--output file] [name filters...]".
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+
+# draw into a dummy video driver, benchmarks must run without a display
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+from Box2D.b2 import world
+
+import terrain
+import log_data
+import view
+from terrain import Terrain
+from bipedal import Bipedal
+from sim import (Simulation, RECORD_OFF, RECORD_FULL, FIDELITY_LOW,
+                 FIDELITY_HIGH)
+from termination import (AnyOf, MaxSteps)
+from algo import (Population, ArrayPopulation)
+
+GENE = [1.5, 1.2, 1.8]
+TRACK = (400, 4, 1)
+
+benchmarks = []
+
+def benchmark(function):
+    """
+    Register a benchmark. The function gets the quick flag and returns a
+    (run, ops) pair: a callable timed on every repeat and the number of
+    operations it performs, for per operation figures.
+    """
+    benchmarks.append(function)
+    return function
+
+
+def measure(run, ops, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return {'repeat': repeat,
+            'ops': ops,
+            'min_s': min(times),
+            'median_s': statistics.median(times),
+            'mean_s': statistics.mean(times),
+            'ops_per_s': ops / min(times)}
+
+
+def build_world(track=TRACK):
+    track = Terrain(*track)
+    sim_world = world(gravity=(0, -10), doSleep=True)
+    return sim_world, track.instantiate(sim_world)
+
+
+@benchmark
+def terrain_generate(quick):
+    cases = {}
+    for roughness in range(6):
+        # bypass the cache, the generation itself is measured
+        run = lambda roughness=roughness: [
+                terrain.generate.__wrapped__(4000, roughness, seed)
+                for seed in range(10)]
+        cases['roughness_%d' % roughness] = (run, 10)
+    return cases
+
+
+@benchmark
+def terrain_build(quick):
+    track = Terrain(4000, 4, 1)
+    chain = Terrain(4000, 4, 1, terrain.CHAIN)
+    track.template, chain.template
+    return {'bodies': (lambda: track.build(world(gravity=(0, -10))), 1),
+            'template': (lambda: track.instantiate(world(gravity=(0, -10))),
+                         1),
+            'chain': (lambda: chain.instantiate(world(gravity=(0, -10))), 1)}
+
+
+@benchmark
+def biped_build(quick):
+    sim_world, track = build_world()
+    x0, y0 = track.get_spawn_pos()
+    return lambda: [Bipedal(None, GENE).build(sim_world, x0, y0)
+                    for i in range(100)], 100
+
+
+@benchmark
+def simulation_run(quick):
+    n_steps = 500 if quick else 3000
+    cases = {}
+    for name, record, shape in [('no_history', RECORD_OFF, terrain.BOXES),
+                                ('history', RECORD_FULL, terrain.BOXES),
+                                ('chain', RECORD_OFF, terrain.CHAIN)]:
+        def run(record=record, shape=shape):
+            race = Simulation(Terrain(*TRACK, shape=shape), Bipedal('b', GENE),
+                              record)
+            race.run(n_steps, termination=AnyOf(MaxSteps(n_steps)))
+        cases[name] = (run, n_steps)
+    # the same simulated time, counted in 60 Hz steps, at every fidelity
+    for name, fidelity in [('low', FIDELITY_LOW), ('high', FIDELITY_HIGH)]:
+        def run(fidelity=fidelity):
+            race = Simulation(Terrain(*TRACK), Bipedal('b', GENE), RECORD_OFF)
+            race.run(n_steps, termination=AnyOf(MaxSteps(n_steps)),
+                     fidelity=fidelity)
+        cases['fidelity_' + name] = (run, n_steps)
+    return cases
+
+
+@benchmark
+def get_shapes(quick):
+    sim_world, track = build_world()
+    biped = Bipedal('b', GENE)
+    biped.build(sim_world, *track.get_spawn_pos())
+    # the lambda keeps the world alive, Box2D frees its bodies with it
+    return lambda world=sim_world: [log_data.get_shapes(biped)
+                                    for i in range(1000)], 1000
+
+
+@benchmark
+def population_evolve(quick):
+    cases = {}
+    sizes = [100, 1000] if quick else [100, 1000, 10000]
+    for size in sizes:
+        pool = Population(size)
+        for c in pool.population:
+            c.fitness = sum(c.gene)
+        cases['population_%d' % size] = (pool.evolve, size)
+
+        array_pool = ArrayPopulation(size, seed=1)
+        array_pool.fitness = array_pool.genes.sum(axis=1)
+        cases['array_population_%d' % size] = (array_pool.evolve, size)
+    return cases
+
+
+@benchmark
+def draw_history(quick):
+    n_frames = 20 if quick else 200
+    history = log_data.Data()
+    race = Simulation(Terrain(*TRACK), Bipedal('b', GENE), RECORD_FULL,
+                      history=history, name='b')
+    race.run(n_frames, termination=AnyOf(MaxSteps(n_frames)))
+    view.start()
+    renderer = view.Renderer(history, ['b'], view.screen)
+    lod = view.Renderer(history, ['b'], view.screen, lod=True)
+    return {'': (lambda: [view.draw_history(history, ['b'], i)
+                          for i in range(n_frames)], n_frames),
+            'shapes': (lambda: [view.draw_history_shapes(history, ['b'], i)
+                                for i in range(n_frames)], n_frames),
+            'renderer': (lambda: [renderer.draw(i) for i in range(n_frames)],
+                         n_frames),
+            'lod': (lambda: [lod.draw(i) for i in range(n_frames)],
+                    n_frames)}
+
+
+@benchmark
+def ghost_race(quick):
+    n_bipeds = 20 if quick else 200
+    n_frames = 20 if quick else 100
+    history = log_data.Data()
+    for i in range(n_bipeds):
+        race = Simulation(Terrain(*TRACK), Bipedal(str(i), GENE), RECORD_FULL,
+                          history=history, name=str(i))
+        race.run(n_frames, termination=AnyOf(MaxSteps(n_frames)))
+    view.start()
+    renderer = view.GhostRenderer(history, list(history.timelines),
+                                  view.screen)
+    return lambda: [renderer.draw(i) for i in range(n_frames)], n_frames
+
+
+@benchmark
+def export(quick):
+    n_frames = 20 if quick else 200
+    history = log_data.Data()
+    race = Simulation(Terrain(*TRACK), Bipedal('b', GENE), RECORD_FULL,
+                      history=history, name='b')
+    race.run(n_frames, termination=AnyOf(MaxSteps(n_frames)))
+    filename = os.path.join(tempfile.mkdtemp(), 'replay.png')
+    return lambda: view.export(history, ['b'], filename), n_frames
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('filters', nargs='*',
+                        help='only run benchmarks containing these strings')
+    parser.add_argument('--quick', action='store_true',
+                        help='smaller sizes and fewer repeats')
+    parser.add_argument('--repeat', type=int, default=None)
+    parser.add_argument('--output', help='JSON file to write the results to')
+    args = parser.parse_args(argv)
+    repeat = args.repeat or (2 if args.quick else 5)
+
+    results = {}
+    for function in benchmarks:
+        if args.filters and not any(f in function.__name__ or
+                                    function.__name__ in f
+                                    for f in args.filters):
+            continue
+        # keep the prints of the simulation out of the JSON output
+        with contextlib.redirect_stdout(io.StringIO()):
+            cases = function(args.quick)
+            if not isinstance(cases, dict):
+                cases = {'': cases}
+            for case, (run, ops) in cases.items():
+                name = function.__name__ + ('.' + case if case else '')
+                if args.filters and not any(f in name for f in args.filters):
+                    continue
+                results[name] = measure(run, ops, repeat)
+
+    report = {'commit': git_commit(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'quick': args.quick,
+              'results': results}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
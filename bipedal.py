@@ -4,15 +4,21 @@ it gets width and height from the sim.py
 and returns the bipedal objects.
 """
 import Box2D
+import logging
 import random
 from math import cos, sin, pi
 from Box2D.b2 import (world, circleShape, staticBody, dynamicBody, polygonShape)
 
+logger = logging.getLogger(__name__)
+
 """define variables"""
 MAX_TORQUE = 1e4
 WHEEL_FRICTION = 5.0
 #CHANGED SPEED TO NEGATIVE TO MOVE FORWARD
 SPEED = 5
+# collision categories, bipeds sharing a world only collide with the terrain
+TERRAIN_CATEGORY = 0x0001
+BIPED_CATEGORY = 0x0002
 
 class Bipedal:
     """ designate the physical variable with the genes """
@@ -21,7 +27,17 @@ class Bipedal:
         self.name = name
 
 
-    def build(self, world, x0, y0):
+    def build(self, world, x0, y0, group=0):
+        """
+        Create the bodies of the biped in the world at (x0, y0). With a
+        positive group the parts of this biped still collide with each other,
+        but not with bipeds of other groups in the same world.
+        """
+        if group:
+            collision = {'categoryBits': BIPED_CATEGORY,
+                         'maskBits': TERRAIN_CATEGORY, 'groupIndex': group}
+        else:
+            collision = {}
         width = self.genome['width']
         height = self.genome['height']
         length1 = self.genome['right_leg']
@@ -30,15 +46,15 @@ class Bipedal:
         """ construct body, head, and neck """
         body = world.CreateDynamicBody(position=(x0, y0))
         body.fixedRotation = True
-        body.CreatePolygonFixture(box=(width, height), density=1, friction=0.3)
+        body.CreatePolygonFixture(box=(width, height), density=1, friction=0.3, **collision)
 
         head = world.CreateDynamicBody(position=(x0, y0+4))
         head.fixedRotation = True
-        head.CreateCircleFixture(radius = 1.8, density=1, friction=0.3)
+        head.CreateCircleFixture(radius = 1.8, density=1, friction=0.3, **collision)
 
         neck = world.CreateDynamicBody(position=(x0, y0+2.5))
         neck.fixedRotation = True
-        neck.CreatePolygonFixture(box = (0.5, 1), density=1, friction=WHEEL_FRICTION)
+        neck.CreatePolygonFixture(box = (0.5, 1), density=1, friction=WHEEL_FRICTION, **collision)
 
         """ Connect the body with the joints, but rotation is not allowed. """
         world.CreateRevoluteJoint(bodyA=head, bodyB=neck, anchor = head.worldCenter, enableMotor = False)
@@ -46,7 +62,7 @@ class Bipedal:
 
         """ Construct the leg and connect it with the body """
         right_leg = world.CreateDynamicBody(position=(x0+1, y0-2))
-        right_leg.CreatePolygonFixture(box = (0.5,3), density=1, friction=WHEEL_FRICTION)
+        right_leg.CreatePolygonFixture(box = (0.5,3), density=1, friction=WHEEL_FRICTION, **collision)
         world.CreateRevoluteJoint(bodyA=body, bodyB=right_leg,
                 anchor = body.worldCenter + (1,-2),
                 lowerAngle = -0.3 * pi, upperAngle = 0.3 * pi,
@@ -55,7 +71,7 @@ class Bipedal:
                 enableMotor = True)
 
         left_leg = world.CreateDynamicBody(position=(x0-1, y0-2))
-        left_leg.CreatePolygonFixture(box = (0.5,3), density=1, friction=WHEEL_FRICTION)
+        left_leg.CreatePolygonFixture(box = (0.5,3), density=1, friction=WHEEL_FRICTION, **collision)
         world.CreateRevoluteJoint(bodyA=body, bodyB=left_leg,
                 anchor = body.worldCenter + (-1, -2),
                 lowerAngle = -0.3 * pi, upperAngle = 0.3 * pi,
@@ -63,7 +79,8 @@ class Bipedal:
                 maxMotorTorque = MAX_TORQUE, motorSpeed = sin(SPEED),
                 enableMotor = True)
 
-        print(width, height)
+        logger.debug('built biped %s: width %s, height %s', self.name, width,
+                     height)
 
         self.bodies = [body, head, neck, right_leg, left_leg]
         self.tracker = body.worldCenter
@@ -0,0 +1,101 @@
+"""
+Checkpoints of evolutionary runs
+A checkpoint holds everything needed to continue a run exactly where it
+stopped: the gene pool (genes, fitnesses and names), its GA hyperparameters,
+the track parameters, the index of the next generation and the states of the
+random generators. Racing is deterministic, so a resumed run reproduces the
+generations an uninterrupted run would have produced bit for bit.
+Checkpoints are gzipped pickles, written to a temporary file first and then
+renamed, so a crash while saving never destroys the previous checkpoint.
+"""
+
+import gzip
+import os
+import pickle
+import random
+
+from algo import (Chromosome, Population, ArrayPopulation)
+
+VERSION = 1
+
+
+def population_state(pool):
+    """
+    Return the state of a Population or ArrayPopulation as plain data
+    """
+    state = {'crossover': pool.crossover, 'elitism': pool.elitism,
+             'mutation': pool.mutation}
+    if isinstance(pool, ArrayPopulation):
+        state.update(kind='array', genes=pool.genes.copy(),
+                     fitness=pool.fitness.copy(),
+                     rng=pool.rng.bit_generator.state)
+    else:
+        state.update(kind='objects',
+                     genes=[list(c.gene) for c in pool.population],
+                     fitness=[c.fitness for c in pool.population],
+                     names=[c.name for c in pool.population])
+    return state
+
+
+def restore_population(state):
+    """
+    Rebuild the Population or ArrayPopulation saved by population_state
+    """
+    params = {'crossover': state['crossover'], 'elitism': state['elitism'],
+              'mutation': state['mutation']}
+    if state['kind'] == 'array':
+        pool = ArrayPopulation(0, **params)
+        pool.genes = state['genes']
+        pool.fitness = state['fitness']
+        pool.rng.bit_generator.state = state['rng']
+        return pool
+
+    pool = Population(0, **params)
+    for gene, fitness, name in zip(state['genes'], state['fitness'],
+                                   state['names']):
+        c = Chromosome(gene)
+        c.fitness = fitness
+        c.name = name
+        pool.population.append(c)
+    return pool
+
+
+def save(filename, pool, generation, terrain_params, **extra):
+    """
+    Save a checkpoint of a run about to evaluate the given generation
+    Arguments:
+        filename:       File to write the checkpoint to
+        pool:           Population or ArrayPopulation of that generation
+        generation:     Index of the next generation to evaluate
+        terrain_params: (length, roughness, seed) of the track
+        extra:          Any other picklable settings of the run
+    """
+    state = {'version': VERSION,
+             'generation': generation,
+             'population': population_state(pool),
+             'terrain_params': tuple(terrain_params),
+             'random_state': random.getstate(),
+             'extra': extra}
+    temporary = filename + '.tmp'
+    with gzip.open(temporary, 'wb') as checkpoint_file:
+        pickle.dump(state, checkpoint_file, pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, filename)
+
+
+def load(filename):
+    """
+    Load a checkpoint, restore the global random state and return a dict with
+    'pool', 'generation', 'terrain_params' and 'extra'
+    """
+    with gzip.open(filename, 'rb') as checkpoint_file:
+        state = pickle.load(checkpoint_file)
+    if state['version'] != VERSION:
+        raise ValueError('unsupported checkpoint version %r'
+                         % state['version'])
+    pool = restore_population(state['population'])
+    # restored last, rebuilding the pool must not consume random numbers
+    random.setstate(state['random_state'])
+    return {'pool': pool,
+            'generation': state['generation'],
+            'terrain_params': state['terrain_params'],
+            'extra': state['extra']}
@@ -0,0 +1,371 @@
+"""
+Fitness evaluation of bipeds, serially or spread over a process pool.
+Box2D worlds cannot be shared between processes, so each evaluation rebuilds
+its own world, terrain and biped from plain parameters: the gene of the
+individual and the (length, roughness, seed) triple of the terrain. Given the
+same seed every worker races on exactly the same track.
+Bulk evaluation records nothing; the few bipeds that are going to be shown
+are raced again with full recording, which reproduces the same run since the
+simulation is deterministic.
+A WorkerPool passed as the number of workers is reused instead of starting
+new processes for every call.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+from itertools import repeat
+import math
+import multiprocessing as mp
+import os
+import time
+
+import metrics
+from sim import Simulation as Sim
+from sim import BatchSimulation
+from sim import (RECORD_OFF, RECORD_FULL, FIDELITY_DEFAULT, FIDELITY_LOW,
+                 FIDELITY_HIGH)
+from terrain import Terrain
+from bipedal import Bipedal as Biped
+from fitness_cache import make_key
+from log_data import Data
+
+
+# result of an evaluation: the fitness score, whether the biped fell, the
+# steps simulated, why the race stopped and how long it took in seconds
+Evaluation = namedtuple('Evaluation',
+                        ['score', 'fell', 'steps', 'reason', 'seconds'])
+
+# reason of evaluations found in the fitness cache
+CACHED = 'Cached'
+
+
+class WorkerPool(ProcessPoolExecutor):
+    """
+    Process pool kept for a whole run and passed wherever a number of workers
+    is expected. Its processes are started by a forkserver (spawned where
+    there is none), never forked from a process whose other threads, e.g.
+    pygame drawing, may hold locks the child would inherit.
+    """
+    def __init__(self, workers=None):
+        """
+        Arguments:
+            workers:    Number of worker processes, all cores if None
+        """
+        self.workers = workers or os.cpu_count() or 1
+        method = 'forkserver' if 'forkserver' in mp.get_all_start_methods() \
+                 else 'spawn'
+        ProcessPoolExecutor.__init__(self, self.workers, mp.get_context(method))
+
+
+def pool_size(workers):
+    """
+    Return the number of worker processes given as a number, None for all
+    cores, or a WorkerPool
+    """
+    if isinstance(workers, WorkerPool):
+        return workers.workers
+    return workers or os.cpu_count() or 1
+
+
+def executor(workers):
+    """
+    Return a context manager giving a process pool: the WorkerPool itself,
+    left running, or a new pool of that many workers, shut down on exit
+    """
+    if isinstance(workers, WorkerPool):
+        return contextlib.nullcontext(workers)
+    return ProcessPoolExecutor(max_workers=pool_size(workers))
+
+
+def evaluate(gene, terrain_params, n_iter=1e4, termination=None,
+             fidelity=None):
+    """
+    Race a single biped and return its Evaluation
+    Arguments:
+        gene:           Gene of the individual to build the biped from
+        terrain_params: (length, roughness, seed) of the track
+        n_iter:         Maximum number of simulation steps
+        termination:    Termination policy, default_policy(n_iter) if None
+        fidelity:       sim.Fidelity of the race, FIDELITY_DEFAULT if None
+    """
+    start = time.perf_counter()
+    terrain = Terrain(*terrain_params)
+    biped = Biped(None, gene)
+    race = Sim(terrain, biped, record=RECORD_OFF)
+    result = race.run(n_iter, termination=termination, fidelity=fidelity)
+    return Evaluation(*result, race.reason, time.perf_counter() - start)
+
+
+def evaluate_batch(genes, terrain_params, n_iter=1e4, termination=None,
+                   fidelity=None):
+    """
+    Race several bipeds together in one world, return the list of their
+    Evaluations
+    Arguments:
+        genes:          Genes of the individuals to build the bipeds from
+        terrain_params: (length, roughness, seed) of the track
+        n_iter:         Maximum number of simulation steps
+        termination:    Termination policy, default_policy(n_iter) if None
+        fidelity:       sim.Fidelity of the race, FIDELITY_DEFAULT if None
+    """
+    terrain = Terrain(*terrain_params)
+    bipeds = [Biped(None, gene) for gene in genes]
+    race = BatchSimulation(terrain, bipeds)
+    results = race.run(n_iter, termination=termination, fidelity=fidelity)
+    return [Evaluation(*result, reason, seconds) for result, reason, seconds
+            in zip(results, race.reasons, race.wall_times)]
+
+
+def record(hist, name, gene, terrain_params, n_iter=1e4, record_every=1,
+           fidelity=None, termination=None):
+    """
+    Race a biped again with recording on and store its timeline in the
+    history under the given name. Return the Evaluation of the run.
+    Arguments:
+        hist:           Data history to store the timeline in, streamed
+                        straight to disk if the history streams to a file
+        name:           Name of the timeline
+        gene:           Gene of the individual to build the biped from
+        terrain_params: (length, roughness, seed) of the track
+        n_iter:         Maximum number of simulation steps
+        record_every:   Save the state only every n-th simulation step
+        fidelity:       sim.Fidelity of the race, the one of the score shown
+                        with it, FIDELITY_DEFAULT if None
+        termination:    Termination policy, default_policy(n_iter) if None
+    """
+    start = time.perf_counter()
+    terrain = Terrain(*terrain_params)
+    race = Sim(terrain, Biped(name, gene), RECORD_FULL, record_every,
+               hist, name)
+    result = race.run(n_iter, termination=termination, fidelity=fidelity)
+    hist.timelines[name].finish()
+    return Evaluation(*result, race.reason, time.perf_counter() - start)
+
+
+def record_population(hist, names, genes, terrain_params, races, n_iter=1e4,
+                      record_every=1, workers=None):
+    """
+    Record several bipeds as record does, spread over a process pool, and
+    store their timelines in the history in the order given. Return the list
+    of their Evaluations.
+    Arguments:
+        hist:           Data history to store the timelines in; if it streams
+                        to a directory, every worker streams its share into
+                        a part directory of it, merged in when done
+        names:          Names of the timelines
+        genes:          Genes of the individuals to build the bipeds from
+        terrain_params: (length, roughness, seed) of the track
+        races:          (fidelity, termination) of every biped, as for record
+        n_iter:         Maximum number of simulation steps
+        record_every:   Save the state only every n-th simulation step
+        workers:        Number of worker processes, as for
+                        evaluate_population
+    """
+    if workers == 1 or len(genes) <= 1:
+        return [record(hist, name, gene, terrain_params, n_iter, record_every,
+                       *race) for name, gene, race in zip(names, genes, races)]
+
+    # contiguous shares, so the timelines keep their order when merged
+    n_parts = min(pool_size(workers), len(genes))
+    bounds = [k*len(genes) // n_parts for k in range(n_parts + 1)]
+    shares = [slice(first, last) for first, last in zip(bounds, bounds[1:])]
+    directories = [os.path.join(hist.path, 'part%03d' % k) if hist.path
+                   else None for k in range(n_parts)]
+    # collect what the workers report along with the results
+    task = (metrics.call_with_metrics, _record_part) if metrics.enabled \
+           else (_record_part,)
+    results = []
+    with executor(workers) as pool:
+        futures = [pool.submit(*task, directory, names[share], genes[share],
+                               races[share], terrain_params, n_iter,
+                               record_every)
+                   for directory, share in zip(directories, shares)]
+        for directory, future in zip(directories, futures):
+            result = future.result()
+            if metrics.enabled:
+                result, values = result
+                metrics.merge(values)
+            evaluations, part = result
+            if directory:
+                hist.merge_from_file(directory)
+            else:
+                hist.merge(part)
+            results += evaluations
+    return results
+
+
+def _record_part(directory, names, genes, races, terrain_params, n_iter,
+                 record_every):
+    # record in a history of its own, streamed to the directory if given or
+    # else sent back whole
+    hist = Data()
+    if directory:
+        hist.stream_to_file(directory)
+    results = [record(hist, name, gene, terrain_params, n_iter, record_every,
+                      *race) for name, gene, race in zip(names, genes, races)]
+    if directory:
+        hist.close()
+        return results, None
+    return results, hist
+
+
+def evaluate_population(genes, terrain_params, n_iter=1e4, workers=None,
+                        cache=None, batch=1, termination=None,
+                        fidelity=None):
+    """
+    Evaluate a list of genes on the same track, return a list of
+    Evaluations in the same order as the genes. Results found in the cache
+    have the reason CACHED and take no time.
+    Arguments:
+        genes:          List of genes to evaluate
+        terrain_params: (length, roughness, seed) of the track
+        n_iter:         Maximum number of simulation steps per biped
+        workers:        Number of worker processes (all cores if None), with
+                        1 the evaluation runs in the calling process, or a
+                        WorkerPool
+        cache:          FitnessCache consulted before simulating, genes
+                        already evaluated on this track are not raced again
+        batch:          Number of bipeds raced together in one world by
+                        BatchSimulation, 1 gives each its own Simulation
+        termination:    Termination policy, default_policy(n_iter) if None
+        fidelity:       sim.Fidelity of the races, FIDELITY_DEFAULT if None
+    """
+    if cache is None:
+        return _evaluate_all(genes, terrain_params, n_iter, workers, batch,
+                             termination, fidelity)
+
+    keys = [cache_key(gene, terrain_params, n_iter, termination, fidelity)
+            for gene in genes]
+    results = [cache.get(key) for key in keys]
+    # race every missing gene once, even if it appears several times
+    missing = {}
+    for key, gene, result in zip(keys, genes, results):
+        if result is None and key not in missing:
+            missing[key] = gene
+    metrics.count('evaluate.cached', len(genes) - len(missing))
+    new_results = _evaluate_all(list(missing.values()), terrain_params,
+                                n_iter, workers, batch, termination, fidelity)
+    new_results = dict(zip(missing, new_results))
+    cache.put_many(list(new_results.items()))
+    return [Evaluation(*result, CACHED, 0.) if result is not None
+            else new_results[key] for key, result in zip(keys, results)]
+
+
+def cache_key(gene, terrain_params, n_iter=1e4, termination=None,
+              fidelity=None):
+    """
+    Return the FitnessCache key of an evaluation with these settings
+    """
+    settings = [n_iter]
+    if termination is not None:
+        settings.append(repr(termination))
+    # the keys of default races stay the ones of earlier cache files
+    if fidelity is not None and fidelity != FIDELITY_DEFAULT:
+        settings.append(list(fidelity))
+    return make_key(gene, terrain_params, settings)
+
+
+def evaluate_promoted(genes, terrain_params, n_iter=1e4,
+                      levels=(FIDELITY_LOW, FIDELITY_HIGH), promote=0.25,
+                      final_termination=None, **options):
+    """
+    Multi-fidelity evaluation: race every gene at the first fidelity level,
+    then race again the best fraction of them at each next level. Return the
+    Evaluations in the order of the genes, each from the highest level its
+    gene was promoted to, and the list of those levels (indices in levels).
+    Scores of different levels do not compare, rank them with
+    promoted_fitness.
+    Arguments:
+        genes:          List of genes to evaluate
+        terrain_params: (length, roughness, seed) of the track
+        n_iter:         Maximum number of simulation steps per biped
+        levels:         sim.Fidelity of every level, cheapest first
+        promote:        Fraction of the bipeds of a level promoted to the
+                        next one, at least one
+        final_termination: Termination policy of the last level, e.g. one
+                        with a target score of that fidelity, the one of the
+                        options if None
+        options:        workers, cache, batch and termination, as for
+                        evaluate_population
+    """
+    def level_options(level):
+        if level == len(levels) - 1 and final_termination is not None:
+            return dict(options, termination=final_termination)
+        return options
+
+    results = evaluate_population(genes, terrain_params, n_iter,
+                                  fidelity=levels[0], **level_options(0))
+    reached = [0]*len(genes)
+    candidates = list(range(len(genes)))
+    for level, fidelity in enumerate(levels[1:], 1):
+        n_promoted = max(1, int(math.ceil(promote * len(candidates))))
+        candidates = sorted(candidates,
+                            key=lambda k: results[k].score)[-n_promoted:]
+        metrics.count('evaluate.promoted', len(candidates))
+        promoted = evaluate_population([genes[k] for k in candidates],
+                                       terrain_params, n_iter,
+                                       fidelity=fidelity,
+                                       **level_options(level))
+        for k, result in zip(candidates, promoted):
+            results[k] = result
+            reached[k] = level
+    return results, reached
+
+
+def promoted_fitness(scores, levels):
+    """
+    Return fitnesses ordering the results of evaluate_promoted by the level
+    reached first and by score within a level: the scores of every level are
+    shifted, all by the same amount, to stay below the lowest fitness of the
+    levels above it
+    Arguments:
+        scores: Scores of the evaluations
+        levels: Level reached by every evaluation
+    """
+    fitnesses = list(scores)
+    floor = None
+    for level in sorted(set(levels), reverse=True):
+        members = [k for k, reached in enumerate(levels) if reached == level]
+        if floor is not None:
+            shift = min(0., floor - 1. - max(scores[k] for k in members))
+            for k in members:
+                fitnesses[k] = scores[k] + shift
+        floor = min(fitnesses[k] for k in members)
+    return fitnesses
+
+
+def _evaluate_all(genes, terrain_params, n_iter, workers, batch,
+                  termination, fidelity):
+    if batch > 1:
+        batches = [genes[i:i+batch] for i in range(0, len(genes), batch)]
+        results = _map(evaluate_batch, batches, terrain_params, n_iter,
+                       termination, fidelity, workers)
+        return [result for batch_results in results
+                for result in batch_results]
+    return _map(evaluate, genes, terrain_params, n_iter, termination, fidelity,
+                workers)
+
+
+def _map(function, items, terrain_params, n_iter, termination, fidelity,
+         workers):
+    if workers == 1 or len(items) <= 1:
+        return [function(item, terrain_params, n_iter, termination, fidelity)
+                for item in items]
+
+    # hand out several items per task to amortize the pickling round trip
+    chunksize = max(1, len(items) // (4*pool_size(workers)))
+    with executor(workers) as pool:
+        if not metrics.enabled:
+            return list(pool.map(function, items, repeat(terrain_params),
+                                 repeat(n_iter), repeat(termination),
+                                 repeat(fidelity), chunksize=chunksize))
+        # collect what the workers report along with the results
+        results = []
+        for result, values in pool.map(
+                metrics.call_with_metrics, repeat(function), items,
+                repeat(terrain_params), repeat(n_iter), repeat(termination),
+                repeat(fidelity), chunksize=chunksize):
+            metrics.merge(values)
+            results.append(result)
+        return results
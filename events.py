@@ -0,0 +1,67 @@
+"""
+Machine-readable record of every evaluation
+EventLog collects one event (a flat dict) per evaluated individual and writes
+them in batches to a JSON lines or CSV file, so large runs do not pay for a
+write, or a console print, per biped. Console output of the modules goes
+through the standard logging module instead, silent below WARNING unless
+configured otherwise.
+"""
+
+import csv
+import json
+
+
+class EventLog:
+    """
+    Buffered writer of events to a .csv file or, for any other extension, a
+    JSON lines file. Use as a context manager or call close() to write the
+    last batch.
+    """
+    def __init__(self, filename, batch=256):
+        """
+        Arguments:
+            filename:   File to append the events to
+            batch:      Number of events collected before writing them
+        """
+        self.filename = filename
+        self.batch = batch
+        self.csv = filename.endswith('.csv')
+        self.events = []
+        self.file = open(filename, 'a', newline='')
+        self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def log(self, **event):
+        """
+        Add an event, all of them should have the same fields for CSV
+        """
+        self.events.append(event)
+        if len(self.events) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if not self.events:
+            return
+        if self.csv:
+            if self.writer is None:
+                self.writer = csv.DictWriter(self.file,
+                                             fieldnames=list(self.events[0]))
+                if self.file.tell() == 0:
+                    self.writer.writeheader()
+            self.writer.writerows(self.events)
+        else:
+            self.file.write(''.join(json.dumps(event) + '\n'
+                                    for event in self.events))
+        self.file.flush()
+        self.events = []
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
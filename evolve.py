@@ -7,59 +7,333 @@ generation is breed to produce the next.
 """
 
 # import modules
-import copy
+import argparse
+import logging
+import os
+import queue
+import random
+import threading
 import view
-from sim import Simulation as Sim
-from terrain import Terrain
-from bipedal import Bipedal as Biped
+import metrics
+import checkpoint
 from algo import Population as Pop
 from log_data import Data
+from evaluate import (evaluate_population, evaluate_promoted,
+                      promoted_fitness, record_population,
+                      WorkerPool)
+from fitness_cache import FitnessCache
+from events import EventLog
+from terrain import (Terrain, BOXES)
+from termination import (AnyOf, CannotBeat, default_policy)
 
 num_gen = 50
 size_gen = 10
 num_shown = 5
+# show every biped of the generation as translucent ghosts colored by fitness
+# instead of only the num_shown best ones
+ghost_race = False
+# worker processes for fitness evaluation, None uses every core and
+# 1 evaluates serially in this process
+num_workers = None
+# bipeds raced together in one world by each worker, 1 races them one by one
+batch_size = 1
+# directory to store the shown timelines of every generation in, for
+# replaying them later with "python view.py <dir>/gen_000", None keeps them
+# only in memory
+save_dir = None
+# extension (e.g. '.png' or '.mp4') of a video of the shown bipeds rendered
+# offscreen into save_dir/gen_<n><ext> for every generation, by num_workers
+# processes, or None; needs save_dir
+export_format = None
+# simulation steps between two recorded states of the shown bipeds, the
+# replay interpolates between them
+record_every = 4
+# SQLite file keeping fitness evaluations across runs, None caches them only
+# in memory for this run
+cache_file = None
+# length of the track in meters, None races on an endless track generated
+# ahead of the bipeds, for open-ended distance fitness
+track_length = 400
+# seed of the track raced by every generation, None draws one for the run
+terrain_seed = None
+# BOXES builds the track from a box per segment, terrain.CHAIN from a single
+# chain shape, smoother and cheaper to simulate on long tracks
+terrain_shape = BOXES
+# fidelities of the evaluation, cheapest first, e.g. (sim.FIDELITY_LOW,
+# sim.FIDELITY_HIGH): the whole generation is screened at the first one and
+# the best promote_fraction of the bipeds are raced again at each next one.
+# Bipeds promoted further rank above the others, and the shown ones are
+# recorded at the fidelity of their score. None races everything at
+# sim.FIDELITY_DEFAULT
+fidelity_levels = None
+promote_fraction = 0.25
+# maximum number of 60 Hz simulation steps of a race
+n_iter = 1e4
+# termination policy of every race (see termination.py), e.g.
+# AnyOf(Stuck(), NoProgress(), Tilted(), MaxSteps(n_iter), FellOff()) to drop
+# hopeless bipeds sooner, None stops them with default_policy(n_iter)
+termination = None
+# with a positive k, races also stop once the biped cannot beat the k-th best
+# score of the previous generation even moving at cannot_beat_speed meters per
+# second from then on. The best k keep their rank, but the target changes
+# every generation and with it the fitness cache keys.
+cannot_beat = 0
+cannot_beat_speed = 5.
 
-def main():
+# file to append per generation timings and counters to as JSON lines, None
+# leaves the instrumentation off
+metrics_file = None
+# generation to run under cProfile (stats saved to gen_<n>.prof), or None
+profile_gen = None
+# .jsonl or .csv file recording the outcome of every evaluation, or None
+events_file = None
+# level of the console log, DEBUG also prints the outcome of every race
+log_level = logging.WARNING
+# file to save the state of the run to, for resuming it with
+# "python evolve.py --resume <file>", or None
+checkpoint_file = None
+# generations between two checkpoints
+checkpoint_every = 1
+# show the best bipeds of every generation, False only evolves
+render = True
+# evaluate the next generation in the background while showing the last one
+pipelined = True
+# generations evaluated ahead of the one being shown
+queue_size = 1
 
-    # Create first generation
-    pool = Pop(size_gen)
+def main(workers=num_workers, save_dir=save_dir, cache_file=cache_file,
+         terrain_seed=terrain_seed, batch_size=batch_size, render=render,
+         pipelined=pipelined, metrics_file=metrics_file,
+         profile_gen=profile_gen, events_file=events_file,
+         checkpoint_file=checkpoint_file, resume=None):
+    """
+    Run the evolution, from scratch or, given resume, from the checkpoint in
+    that file
+    """
+    if resume:
+        # continue exactly where the checkpointed run stopped
+        state = checkpoint.load(resume)
+        pool = state['pool']
+        start = state['generation']
+        terrain_params = state['terrain_params']
+        target = state['extra'].get('target')
+    else:
+        # Create first generation
+        pool = Pop(size_gen)
+        start = 0
+        target = None
+        # seeded, so that every worker process races on the same track
+        if terrain_seed is None:
+            terrain_seed = random.randrange(2**31)
+        terrain_params = Terrain(track_length, 4, terrain_seed,
+                                 terrain_shape).params
 
-    # Step through generations
-    for j in range(num_gen):
+    if metrics_file:
+        metrics.enable()
+    # one pool for the whole run, started before any render thread exists
+    worker_pool = WorkerPool(workers) if workers != 1 else None
+    options = {'workers': worker_pool or workers,
+               'batch_size': batch_size,
+               'save_dir': save_dir,
+               'export_format': export_format if save_dir else None}
+    generations = run_generations(pool, terrain_params, start, metrics_file,
+                                  profile_gen, checkpoint_file, cache_file,
+                                  events_file, target, **options)
+    try:
+        if not render:
+            for hist, timelines, fitness in generations:
+                pass
+        elif pipelined:
+            show_pipelined(generations)
+        else:
+            for hist, timelines, fitness in generations:
+                show(hist, timelines, fitness)
+    finally:
+        if worker_pool:
+            worker_pool.shutdown()
 
-        # initialize data histogram for sim visualization
-        hist = Data()
-        terrain = Terrain(400, 4)
+def run_generations(pool, terrain_params, start=0, metrics_file=None,
+                    profile_gen=None, checkpoint_file=None, cache_file=None,
+                    events_file=None, target=None, **options):
+    """
+    Evaluate and evolve the gene pool generation after generation, from the
+    generation start on, yielding the history of the bipeds to show, their
+    timeline names and their fitness by name before breeding the next
+    generation. The options are
+    passed on to run_generation. target is the score the first generation
+    raced has to beat, see run_generation.
+    The fitness cache and the event log are opened here, in the thread
+    iterating over the generations, which is the only one using them (an
+    SQLite connection cannot be shared between threads).
+    """
+    metrics_out = open(metrics_file, 'a') if metrics_file else None
+    # elites and duplicate genes are not raced twice on the same track
+    cache = FitnessCache(path=cache_file)
+    event_log = EventLog(events_file) if events_file else None
+    try:
+        # Step through generations
+        for j in range(start, num_gen):
+            if j == profile_gen:
+                with metrics.profile('gen_%d.prof' % j):
+                    hist, shown, fitness, target = run_generation(
+                            j, pool, terrain_params, cache=cache,
+                            event_log=event_log, target=target, **options)
+            else:
+                hist, shown, fitness, target = run_generation(
+                        j, pool, terrain_params, cache=cache,
+                        event_log=event_log, target=target, **options)
+
+            yield hist, shown, fitness
+
+            # evolve gene pool
+            pool.evolve()
+            if metrics_out:
+                metrics.write_jsonl(metrics_out, generation=j)
+            if checkpoint_file and (j + 1) % checkpoint_every == 0:
+                checkpoint.save(checkpoint_file, pool, j + 1, terrain_params,
+                                target=target)
+    finally:
+        cache.close()
+        if event_log:
+            event_log.close()
+        if metrics_out:
+            metrics_out.close()
 
-        # create pybox2d dynamic bodies based on individual's gene
-        gen = [Biped(pool.population[i].name, pool.population[i].gene) for i in range(size_gen)]
+def race_policy(target=None):
+    """
+    Return the termination policy of the races, None for the default one,
+    also stopping the bipeds that cannot beat the target score if given
+    """
+    if target is None:
+        return termination
+    policy = termination if termination is not None else \
+             default_policy(n_iter)
+    return AnyOf(policy, CannotBeat(target, cannot_beat_speed, n_iter))
 
-        for k, biped in enumerate(gen):
+def run_generation(j, pool, terrain_params, workers=None, cache=None,
+                   batch_size=1, save_dir=None, event_log=None,
+                   export_format=None, target=None):
+    """
+    Evaluate generation j, record its best bipeds and return their history,
+    timeline names, fitness by name and the target of the next generation. With cannot_beat,
+    the races of the highest fidelity stop once they cannot beat the target,
+    the cannot_beat-th best raw score of that fidelity in the generation
+    before, None if it had fewer races of that fidelity.
+    """
+    # initialize data histogram for sim visualization
+    hist = Data()
 
-            # specify terrain and biped to race
-            race = Sim(terrain, biped)
+    # race the whole generation without recording anything
+    genes = [c.gene for c in pool.population[:size_gen]]
+    policy, final_policy = race_policy(), race_policy(target)
+    with metrics.timer('generation.evaluate'):
+        if fidelity_levels:
+            results, levels = evaluate_promoted(genes, terrain_params, n_iter,
+                                                fidelity_levels,
+                                                promote_fraction,
+                                                final_policy,
+                                                workers=workers, cache=cache,
+                                                batch=batch_size,
+                                                termination=policy)
+            # scores of different fidelities do not compare, the bipeds
+            # promoted furthest rank first
+            fitnesses = promoted_fitness([r.score for r in results], levels)
+            top = len(fidelity_levels) - 1
+        else:
+            results = evaluate_population(genes, terrain_params, n_iter,
+                                          workers, cache, batch_size,
+                                          final_policy)
+            fitnesses = [r.score for r in results]
+            levels, top = [0]*len(results), 0
+    # how each biped was raced, to record it the same way
+    races = {c.name: (fidelity_levels[level] if fidelity_levels else None,
+                      final_policy if level == top else policy)
+             for c, level in zip(pool.population, levels)}
+    top_scores = sorted(result.score for result, level in zip(results, levels)
+                        if level == top)
+    if cannot_beat and len(top_scores) >= cannot_beat:
+        next_target = top_scores[-cannot_beat]
+    else:
+        next_target = None
+    for c, fitness in zip(pool.population, fitnesses):
+        c.fitness = fitness
+    if event_log:
+        for k, (c, result) in enumerate(zip(pool.population, results)):
+            event = result._asdict()
+            if fidelity_levels:
+                event['level'] = levels[k]
+            event_log.log(generation=j, name=c.name, gene=list(c.gene),
+                          **event)
 
-            if not hist.terrain:
-                hist.set_terrain(terrain)
+    # resort gene pool
+    pool.population = list(sorted(pool.population, key=lambda x: x.fitness))
+
+    # record again only the bipeds which will be shown
+    if save_dir:
+        gen_dir = os.path.join(save_dir, 'gen_%03d' % j)
+        hist.stream_to_file(gen_dir)
+    shown = pool.population[:size_gen] if ghost_race else \
+            pool.population[-num_shown:]
+    with metrics.timer('generation.record'):
+        # raced as for their scores, so the replays match them
+        record_population(hist, [c.name for c in shown],
+                          [c.gene for c in shown], terrain_params,
+                          [races[c.name] for c in shown], n_iter,
+                          record_every, workers)
+    if save_dir:
+        hist.close()
+        hist = Data()
+        hist.read_from_file(gen_dir)
+        if export_format:
+            with metrics.timer('generation.export'):
+                view.export_parallel(gen_dir, gen_dir + export_format,
+                                     workers)
 
-            # run simulation without visualization
-            score, bb, time = race.run(1e4)
+    return (hist, [s.name for s in shown], {s.name: s.fitness for s in shown},
+            next_target)
 
-            # store sim data and fitness evaluation
-            pool.population[k].fitness = score
-            hist.timelines[biped.name] = race.history.timelines['timeline']
+def show(hist, timelines, fitness=None):
+    # visualize top bipeds' simulations, ghosts colored by their fitness
+    view.start()
+    view.run(hist, timelines, speed=3, ghosts=ghost_race, fitness=fitness)
 
-        # resort gene pool
-        pool.population = list(sorted(pool.population, key=lambda x: x.fitness))
+def show_pipelined(generations):
+    """
+    Run the generations in a background thread and show each one in this
+    thread (pygame has to draw from the main thread) as soon as it is ready.
+    The bounded queue keeps the evaluation at most queue_size generations
+    ahead of the display.
+    """
+    ready = queue.Queue(maxsize=queue_size)
+    errors = []
 
-        # visualize top bipeds' simulations
-        shown = pool.population[-num_shown:]
-        timelines = [s.name for s in shown]
-        view.start()
-        view.run(hist, timelines, speed=3)
+    def produce():
+        try:
+            for generation in generations:
+                ready.put(generation)
+        except Exception as error:
+            errors.append(error)
+        finally:
+            ready.put(None)
 
-        # evolve gene pool
-        pool.evolve()
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    while True:
+        generation = ready.get()
+        if generation is None:
+            break
+        show(*generation)
+    producer.join()
+    if errors:
+        raise errors[0]
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Evolve walking bipeds.')
+    parser.add_argument('--resume', metavar='CHECKPOINT',
+                        help='continue the run saved in this checkpoint')
+    parser.add_argument('--checkpoint', default=checkpoint_file,
+                        help='file to save checkpoints of the run to')
+    args = parser.parse_args()
+    logging.basicConfig(level=log_level,
+                        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    main(checkpoint_file=args.checkpoint or args.resume, resume=args.resume)
@@ -0,0 +1,102 @@
+"""
+Cache of fitness evaluations
+An evaluation only depends on the gene, the track and the simulation settings,
+so its (score, fell, steps) result can be reused for elites carried over to
+the next generation and for duplicate genes. Results are kept in an in-memory
+LRU dictionary and, optionally, in an SQLite file shared between runs.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import sqlite3
+
+
+def make_key(gene, terrain_params, settings=()):
+    """
+    Return a canonical hash of everything an evaluation depends on
+    Arguments:
+        gene:           Gene of the individual
+        terrain_params: (length, roughness, seed) of the track
+        settings:       Any other JSON-serializable simulation settings
+    """
+    canonical = json.dumps([[float(x) for x in gene], list(terrain_params),
+                            settings])
+    return hashlib.sha1(canonical.encode()).hexdigest()
+
+
+class FitnessCache:
+    """
+    LRU cache of (score, fell, steps) evaluation results, keyed by make_key,
+    with an optional SQLite file behind it
+    """
+    def __init__(self, size=100000, path=None):
+        """
+        Arguments:
+            size:   Maximum number of results kept in memory
+            path:   SQLite file to persist the results in, or None
+        """
+        self.size = size
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path)
+            self.db.execute('CREATE TABLE IF NOT EXISTS fitness '
+                            '(key TEXT PRIMARY KEY, score REAL, '
+                            'fell INTEGER, steps INTEGER)')
+
+    def __len__(self):
+        return len(self.results)
+
+    def get(self, key):
+        """
+        Return the cached result for the key, or None
+        """
+        if key in self.results:
+            self.results.move_to_end(key)
+            self.hits += 1
+            return self.results[key]
+        if self.db:
+            row = self.db.execute('SELECT score, fell, steps FROM fitness '
+                                  'WHERE key = ?', (key,)).fetchone()
+            if row:
+                score, fell, steps = row
+                self._remember(key, (score, bool(fell), steps))
+                self.hits += 1
+                return self.results[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, result):
+        """
+        Store the result of an evaluation, only its first three items
+        (score, fell, steps) are kept
+        """
+        self.put_many([(key, result)])
+
+    def put_many(self, items):
+        """
+        Store a list of (key, result) pairs, in one transaction for the file
+        """
+        items = [(key, tuple(result[:3])) for key, result in items]
+        for key, result in items:
+            self._remember(key, result)
+        if self.db:
+            with self.db:
+                self.db.executemany(
+                        'INSERT OR REPLACE INTO fitness VALUES (?, ?, ?, ?)',
+                        [(key, score, int(fell), steps)
+                         for key, (score, fell, steps) in items])
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    def _remember(self, key, result):
+        self.results[key] = result
+        self.results.move_to_end(key)
+        if len(self.results) > self.size:
+            self.results.popitem(last=False)
@@ -0,0 +1,149 @@
+"""
+Island model of the genetic algorithm.
+Several Populations evolve side by side, each in its own process which also
+races its own individuals. Every few generations each island sends copies of
+its best individuals to its neighbours, which replace their worst ones with
+them. An island only waits for the migrants of its own neighbours, never for
+the whole archipelago, and the separate pools keep more diversity than one
+large population.
+Run as "python islands.py" to evolve with the settings below.
+"""
+
+import logging
+import multiprocessing as mp
+import random
+
+from algo import (Chromosome, Population as Pop)
+from evaluate import evaluate_population
+from fitness_cache import FitnessCache
+
+logger = logging.getLogger(__name__)
+
+num_islands = 4
+num_gen = 50
+size_island = 10
+# generations between two migrations
+migration_interval = 5
+# individuals sent to every neighbour at each migration
+num_migrants = 2
+# 'ring' sends to the next island only, 'all' to every other island
+topology = 'ring'
+
+RING = 'ring'
+ALL_TO_ALL = 'all'
+
+
+def neighbours(index, n_islands, topology=RING):
+    """
+    Return the indices of the islands receiving the migrants of an island
+    """
+    if n_islands == 1:
+        return []
+    if topology == RING:
+        return [(index + 1) % n_islands]
+    if topology == ALL_TO_ALL:
+        return [i for i in range(n_islands) if i != index]
+    raise ValueError('unknown topology %r' % topology)
+
+
+def migrate(pool, inboxes, index, targets, sources, n_migrants):
+    """
+    Send the best individuals of the pool to the target inboxes, then replace
+    the worst individuals with the migrants from every source island
+    Arguments:
+        pool:       Population sorted by fitness, fittest last
+        inboxes:    Queues of all the islands
+        index:      Index of this island
+        targets:    Indices of the islands to send migrants to
+        sources:    Number of islands sending migrants to this one
+        n_migrants: Number of individuals sent to every target
+    """
+    migrants = [(list(c.gene), c.fitness)
+                for c in pool.population[-n_migrants:]]
+    for target in targets:
+        inboxes[target].put(migrants)
+
+    arrived = []
+    for i in range(sources):
+        arrived.extend(inboxes[index].get())
+    immigrants = []
+    for gene, fitness in arrived:
+        c = Chromosome(gene)
+        c.fitness = fitness
+        immigrants.append(c)
+    # the worst individuals make room for the immigrants
+    pool.population = sorted(immigrants + pool.population[len(immigrants):],
+                             key=lambda x: x.fitness)
+
+
+def run_island(index, n_islands, inboxes, results, terrain_params, seed,
+               settings):
+    """
+    Evolve one island, in its own process, and put its final population on
+    the results queue as (index, genes, fitnesses)
+    """
+    random.seed(seed)
+    pool = Pop(settings['size'])
+    cache = FitnessCache()
+    targets = neighbours(index, n_islands, settings['topology'])
+    sources = sum(index in neighbours(i, n_islands, settings['topology'])
+                  for i in range(n_islands))
+
+    for j in range(settings['num_gen']):
+        genes = [c.gene for c in pool.population]
+        # no nested process pools, each island races its own bipeds
+        results_gen = evaluate_population(genes, terrain_params, 1e4, 1,
+                                          cache)
+        for c, result in zip(pool.population, results_gen):
+            c.fitness = result.score
+        pool.population = sorted(pool.population, key=lambda x: x.fitness)
+        logger.info('island %d generation %d best %.2f', index, j,
+                    pool.population[-1].fitness)
+
+        if (j + 1) % settings['interval'] == 0 and targets:
+            migrate(pool, inboxes, index, targets, sources,
+                    settings['n_migrants'])
+        if j + 1 < settings['num_gen']:
+            pool.evolve()
+
+    results.put((index, [list(c.gene) for c in pool.population],
+                 [c.fitness for c in pool.population]))
+
+
+def run_islands(n_islands=num_islands, num_gen=num_gen, size=size_island,
+                topology=topology, interval=migration_interval,
+                n_migrants=num_migrants, terrain_params=None, seed=None):
+    """
+    Evolve n_islands populations in parallel processes with migration, return
+    a list with the (genes, fitnesses) of every island's final population,
+    fittest last
+    """
+    if seed is None:
+        seed = random.randrange(2**31)
+    if terrain_params is None:
+        terrain_params = (400, 4, seed)
+    settings = {'size': size, 'num_gen': num_gen, 'topology': topology,
+                'interval': interval, 'n_migrants': n_migrants}
+
+    inboxes = [mp.Queue() for i in range(n_islands)]
+    results = mp.Queue()
+    processes = [mp.Process(target=run_island,
+                            args=(i, n_islands, inboxes, results,
+                                  terrain_params, seed + i, settings))
+                 for i in range(n_islands)]
+    for process in processes:
+        process.start()
+    # read before joining, a process does not exit with unread queue data
+    final = {}
+    for process in processes:
+        index, genes, fitnesses = results.get()
+        final[index] = genes, fitnesses
+    for process in processes:
+        process.join()
+    return [final[i] for i in range(n_islands)]
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    for i, (genes, fitnesses) in enumerate(run_islands()):
+        print('Island %d best: %.2f %s' % (i, fitnesses[-1], genes[-1]))
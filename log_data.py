@@ -1,21 +1,28 @@
 """
 History of simulation states
-Objects of class StateHistory keep the shapes (in correct positions) of all the
-simulated bodies at each time step, so it can be saved and visualised
-separately. See documentation of StateHistory.
+Objects of class Data keep the static terrain shapes once and, for each named
+Timeline, the poses of all the simulated bodies at each time step, so it can be
+saved and visualised separately. See documentation of Data and Timeline.
 Additional helper functions serve to extract the transformed shapes from body
 attributes.
 """
 
-import shelve
+import os
+import json
+import logging
+import shutil
+import math
+import numpy as np
+import metrics
 import Box2D  # The main library
-from Box2D.b2 import (world, polygonShape, circleShape, edgeShape, vec2)
-from collections import namedtuple
+from Box2D.b2 import (world, polygonShape, circleShape, edgeShape, chainShape, vec2)
+
+logger = logging.getLogger(__name__)
 
 
 class Data:
     """
-    History of simulation states - stores shapes for each time step
+    History of simulation states - stores body poses for each time step
     To save memory, all static bodies are stored once for all history, an
     object with a collection of those in the .bodies attribute should be passed
     to the constructor. Dynamic bodies can be saved at each timestep via the
@@ -29,6 +36,7 @@ class Data:
             name:   Identifier for finding in save files
         """
         self.name = name
+        self.path = None
         if terrain:
             self.terrain = get_shapes(terrain)
         else:
@@ -41,14 +49,22 @@ class Data:
         """
         self.terrain = get_shapes(terrain)
 
-    Timeline = namedtuple('timeline', ['vehicle', 'vehicle_states',
-        'tracker_states'])
-
-    def new_timeline(self, vehicle, name='timeline'):
+    def new_timeline(self, vehicle, name='timeline', every=1):
+        """
+        Create the named timeline, saving a state every n-th simulation step
+        """
         if name in self.timelines:
-            print('Warning, overwriting existing timeline "%s"' %name)
-        timeline = self.Timeline(vehicle, [], [])
+            logger.warning('overwriting existing timeline "%s"', name)
+        if self.path:
+            names = list(self.timelines)
+            index = names.index(name) if name in names else len(names)
+            prefix = os.path.join(self.path, str(index))
+            timeline = TimelineWriter(vehicle, prefix, every=every)
+        else:
+            timeline = Timeline(vehicle, every=every)
         self.timelines[name] = timeline
+        if self.path:
+            self._write_header(self.path)
         return timeline
 
     def save_state(self, vehicle, timename='timeline'):
@@ -61,45 +77,172 @@ class Data:
         """
         if timename not in self.timelines:
             self.new_timeline(vehicle, timename)
-        shapes = get_shapes(vehicle)
-        self.timelines[timename].vehicle_states.append(shapes)
-        tracker = vec2(vehicle.tracker)
-        self.timelines[timename].tracker_states.append(tracker)
+        self.timelines[timename].save_state()
 
-    def _save_state_timeline(timeline):
+    def save_tracker(self, vehicle, timename='timeline'):
         """
-        Alternative way of saving a state, called as a method of a timeline
+        Save only the tracker position of the vehicle, skipping the shapes.
+        Arguments:
+            vehicle:    Object with the tracked position in vehicle.tracker
+            timename:   Name of the timeline
         """
-        shapes = get_shapes(timeline.vehicle)
-        timeline.vehicle_states.append(shapes)
-        tracker = vec2(timeline.vehicle.tracker)
-        timeline.tracker_states.append(tracker)
-    Timeline.save_state = _save_state_timeline
+        if timename not in self.timelines:
+            self.new_timeline(vehicle, timename)
+        self.timelines[timename].save_tracker()
 
     @property
     def max_length(self):
         if self.timelines:
-            return max([len(self.timelines[key].vehicle_states) for key in
-                                self.timelines])
+            return max([len(self.timelines[key]) for key in self.timelines])
+
+    @property
+    def max_steps(self):
+        """Number of simulation steps covered by the longest timeline"""
+        if self.timelines:
+            return max([timeline.n_steps
+                        for timeline in self.timelines.values()])
 
     def write_to_file(self, filename):
         """
-        NOT IMPLEMENTED! Store history in a file
+        Store history in a directory: a JSON header with the terrain shapes and
+        the geometry of every timeline, and raw float32 pose and tracker files
+        per timeline which read_from_file can memory-map. Timelines already
+        streamed into the same directory are just flushed.
+        Arguments:
+            filename:   Directory to store the history in
         """
-        #open file for storing the history
-        shelf = shelve.open(filename)
-        # TODO: use self.name?
-        shelf.setdefault('histories', [])
-        hist_list = shelf['histories']
-        hist_list.append(history)
-        shelf['histories'] = hist_list
-        shelf.close()
+        metrics.count('data.write_to_file')
+        os.makedirs(filename, exist_ok=True)
+        prefixes = self._file_prefixes(filename, len(self.timelines))
+        for prefix, timeline in zip(prefixes, self.timelines.values()):
+            if isinstance(timeline, TimelineWriter):
+                timeline.flush()
+                if os.path.abspath(filename) != os.path.abspath(self.path):
+                    for ext in ('.poses', '.trackers'):
+                        shutil.copyfile(timeline.prefix + ext, prefix + ext)
+            else:
+                timeline.vehicle_states.tofile(prefix + '.poses')
+                timeline.tracker_states.tofile(prefix + '.trackers')
+        self._write_header(filename)
 
     def read_from_file(self, filename):
         """
-        NOT IMPLEMENTED! Load history from a file
+        Load history stored by write_to_file or streamed during a simulation.
+        The timeline arrays are memory-mapped, so only the steps which are
+        drawn are actually read from the disk.
+        Arguments:
+            filename:   Directory the history was stored in
+        """
+        metrics.count('data.read_from_file')
+        header = _read_header(filename)
+        self.name = header['name']
+        self.terrain = [params_to_shape(params) for params in
+                        header['terrain']] if header['terrain'] else None
+        self.timelines = {}
+        prefixes = self._file_prefixes(filename, len(header['timelines']))
+        for prefix, entry in zip(prefixes, header['timelines']):
+            poses = _map_array(prefix + '.poses', (entry['n_bodies'], 3))
+            trackers = _map_array(prefix + '.trackers', (2,))
+            self.timelines[entry['name']] = Timeline.from_arrays(
+                    entry['geometry'], poses, trackers, entry.get('every', 1))
+
+    def merge(self, other):
+        """
+        Add the finished timelines of another history kept in memory, e.g. one
+        recorded in another process, keeping the longer of the two terrains
+        """
+        self._merge_terrain(other.terrain)
+        for name, timeline in other.timelines.items():
+            if name in self.timelines:
+                logger.warning('overwriting existing timeline "%s"', name)
+            self.timelines[name] = timeline
+
+    def merge_from_file(self, filename):
+        """
+        Add the timelines of a history stored in a directory, e.g. streamed by
+        another process. If this history streams to a directory too, their
+        files are moved into it and the other directory is removed.
+        Arguments:
+            filename:   Directory the other history was stored in
+        """
+        if not self.path:
+            other = Data()
+            other.read_from_file(filename)
+            self.merge(other)
+            return
+        header = _read_header(filename)
+        self._merge_terrain([params_to_shape(params) for params in
+                             header['terrain']] if header['terrain'] else None)
+        prefixes = self._file_prefixes(filename, len(header['timelines']))
+        for prefix, entry in zip(prefixes, header['timelines']):
+            name = entry['name']
+            names = list(self.timelines)
+            index = names.index(name) if name in names else len(names)
+            target = os.path.join(self.path, str(index))
+            for ext in ('.poses', '.trackers'):
+                os.replace(prefix + ext, target + ext)
+            poses = _map_array(target + '.poses', (entry['n_bodies'], 3))
+            trackers = _map_array(target + '.trackers', (2,))
+            self.timelines[name] = Timeline.from_arrays(
+                    entry['geometry'], poses, trackers, entry.get('every', 1))
+        shutil.rmtree(filename)
+        self._write_header(self.path)
+
+    def stream_to_file(self, filename):
+        """
+        Stream all timelines created from now on into a directory while they
+        are saved, instead of keeping them in memory. Call close() when done.
+        Arguments:
+            filename:   Directory to store the history in
+        """
+        os.makedirs(filename, exist_ok=True)
+        self.path = filename
+        self._write_header(filename)
+
+    def close(self):
+        """
+        Finish all streamed timelines and write the header describing them
         """
-        pass
+        for timeline in self.timelines.values():
+            if isinstance(timeline, TimelineWriter):
+                timeline.finish()
+        if self.path:
+            self._write_header(self.path)
+
+    def __getstate__(self):
+        # Box2D shapes cannot be pickled, the terrain travels as parameters
+        state = self.__dict__.copy()
+        if self.terrain:
+            state['terrain'] = [shape_to_params(shape)
+                                for shape in self.terrain]
+        return state
+
+    def __setstate__(self, state):
+        if state['terrain']:
+            state['terrain'] = [params_to_shape(params)
+                                for params in state['terrain']]
+        self.__dict__.update(state)
+
+    def _merge_terrain(self, terrain):
+        # the chunks of an endless track grow with the furthest biped
+        if terrain and len(terrain) > len(self.terrain or []):
+            self.terrain = terrain
+
+    def _file_prefixes(self, filename, n_timelines):
+        return [os.path.join(filename, str(i)) for i in range(n_timelines)]
+
+    def _write_header(self, filename):
+        terrain = [shape_to_params(shape) for shape in self.terrain] \
+                if self.terrain else None
+        timelines = [{'name': name,
+                      'n_bodies': timeline.poses.shape[1],
+                      'every': timeline.every,
+                      'geometry': timeline.geometry}
+                     for name, timeline in self.timelines.items()]
+        header = {'name': self.name, 'terrain': terrain,
+                  'timelines': timelines}
+        with open(os.path.join(filename, HEADER_FILE), 'w') as header_file:
+            json.dump(header, header_file)
 
     def get_shapes(self, index, timeline='timeline'):
         """
@@ -108,7 +251,296 @@ class Data:
             index:      index of the entry in the history
             timeline:   name of the timeline ('timeline' by default)
         """
-        return self.timelines[timeline].vehicle_states[index]
+        return self.timelines[timeline].get_shapes(index)
+
+
+HEADER_FILE = 'history.json'
+
+
+def _read_header(filename):
+    """
+    Return the JSON header of a history stored in the directory
+    """
+    with open(os.path.join(filename, HEADER_FILE)) as header_file:
+        return json.load(header_file)
+
+
+class Timeline:
+    """
+    States of one vehicle over time, stored compactly
+    Instead of whole shapes only the pose (x, y, angle) of every body and the
+    tracker position are kept, in float32 arrays which grow by doubling. The
+    geometry of the fixtures is read once in body coordinates, so transformed
+    shapes can be rebuilt for any saved step when they are drawn.
+    States may be saved only every n-th simulation step, pose_at and
+    tracker_at interpolate between them for any step.
+    """
+    def __init__(self, vehicle, capacity=1024, every=1):
+        """
+        Arguments:
+            vehicle:    Object with list of dynamic bodies in vehicle.bodies
+                        and the tracked position in vehicle.tracker
+            capacity:   Number of states to preallocate
+            every:      Steps of sim.BASE_TIME_STEP between two saved states
+        """
+        self.vehicle = vehicle
+        self.every = every
+        self.geometry = get_local_geometry(vehicle)
+        self.n_states = 0
+        self.n_trackers = 0
+        self.poses = np.empty((capacity, len(vehicle.bodies), 3), np.float32)
+        self.trackers = np.empty((capacity, 2), np.float32)
+
+    @classmethod
+    def from_arrays(cls, geometry, poses, trackers, every=1):
+        """
+        Create a finished timeline from saved geometry and arrays, e.g. ones
+        memory-mapped from a file
+        """
+        timeline = cls.__new__(cls)
+        timeline.vehicle = None
+        timeline.every = every
+        timeline.geometry = geometry
+        timeline.poses = poses
+        timeline.trackers = trackers
+        timeline.n_states = len(poses)
+        timeline.n_trackers = len(trackers)
+        return timeline
+
+    def __len__(self):
+        return self.n_states
+
+    @property
+    def vehicle_states(self):
+        """Saved poses as an array of shape (steps, bodies, [x, y, angle])"""
+        return self.poses[:self.n_states]
+
+    @property
+    def tracker_states(self):
+        """Saved tracker positions as an array of shape (steps, 2)"""
+        return self.trackers[:self.n_trackers]
+
+    @property
+    def n_steps(self):
+        """Number of simulation steps covered by the saved states"""
+        # every is fractional for states saved at a coarser fidelity
+        return int(round((max(self.n_trackers, 1) - 1)*self.every)) + 1
+
+    def pose_at(self, step):
+        """
+        Return the poses of all bodies at a simulation step, which may be
+        fractional, interpolated between the saved states around it. Angles
+        turn the short way round. Steps beyond the ends give the first or
+        last saved pose.
+        """
+        return interpolate(self.vehicle_states, step / self.every, True)
+
+    def tracker_at(self, step):
+        """
+        Return the tracker position at a simulation step, like pose_at
+        """
+        return interpolate(self.tracker_states, step / self.every)
+
+    def save_state(self):
+        """
+        Save the current pose of all the bodies and the tracker position
+        """
+        if self.n_states == len(self.poses):
+            self.poses = _grow(self.poses)
+        pose = self.poses[self.n_states]
+        for i, body in enumerate(self.vehicle.bodies):
+            position = body.position
+            pose[i] = position[0], position[1], body.angle
+        self.n_states += 1
+        self.save_tracker()
+
+    def save_tracker(self):
+        """
+        Save only the current tracker position
+        """
+        if self.n_trackers == len(self.trackers):
+            self.trackers = _grow(self.trackers)
+        self.trackers[self.n_trackers] = tuple(self.vehicle.tracker)
+        self.n_trackers += 1
+
+    def finish(self):
+        """
+        Trim the preallocated room and drop the reference to the vehicle (and
+        with it the whole Box2D world) once nothing more will be saved
+        """
+        self.poses = self.poses[:self.n_states].copy()
+        self.trackers = self.trackers[:self.n_trackers].copy()
+        self.vehicle = None
+
+    def get_shapes(self, index):
+        """
+        Return all shapes of the vehicle transformed to the pose saved at index
+        """
+        if index >= self.n_states:
+            raise IndexError('timeline index out of range')
+        return _posed_shapes(self.geometry, self.poses[index].tolist())
+
+
+class TimelineWriter:
+    """
+    Timeline streamed to disk while the simulation runs
+    States are collected in a small in-memory Timeline and appended to the
+    .poses and .trackers files of the prefix whenever a chunk is full, so the
+    memory used stays constant however long the simulation is.
+    """
+    def __init__(self, vehicle, prefix, chunk=1024, every=1):
+        """
+        Arguments:
+            vehicle:    Object with list of dynamic bodies in vehicle.bodies
+                        and the tracked position in vehicle.tracker
+            prefix:     Path of the files without extension
+            chunk:      Number of states to collect before writing them
+            every:      Steps of sim.BASE_TIME_STEP between two saved states
+        """
+        self.vehicle = vehicle
+        self.prefix = prefix
+        self.every = every
+        self.buffer = Timeline(vehicle, chunk, every)
+        self.geometry = self.buffer.geometry
+        self.n_states = 0
+        self.poses_file = open(prefix + '.poses', 'wb')
+        self.trackers_file = open(prefix + '.trackers', 'wb')
+
+    def __len__(self):
+        return self.n_states + self.buffer.n_states
+
+    @property
+    def poses(self):
+        return self.buffer.poses
+
+    @property
+    def n_steps(self):
+        return int(round((max(len(self), 1) - 1)*self.every)) + 1
+
+    def save_state(self):
+        self.buffer.save_state()
+        if self.buffer.n_trackers == len(self.buffer.trackers):
+            self.flush()
+
+    def save_tracker(self):
+        self.buffer.save_tracker()
+        if self.buffer.n_trackers == len(self.buffer.trackers):
+            self.flush()
+
+    def flush(self):
+        """
+        Append the collected states to the files
+        """
+        if self.poses_file.closed:
+            return
+        metrics.count('data.states_written', self.buffer.n_trackers)
+        self.buffer.vehicle_states.tofile(self.poses_file)
+        self.buffer.tracker_states.tofile(self.trackers_file)
+        self.poses_file.flush()
+        self.trackers_file.flush()
+        self.n_states += self.buffer.n_states
+        self.buffer.n_states = 0
+        self.buffer.n_trackers = 0
+
+    def finish(self):
+        """
+        Write what is left and close the files
+        """
+        self.flush()
+        self.poses_file.close()
+        self.trackers_file.close()
+        self.vehicle = None
+        self.buffer.vehicle = None
+
+    def get_shapes(self, index):
+        """
+        Return all shapes of the vehicle transformed to the pose saved at
+        index, read back from the file if it was written already
+        """
+        if index >= self.n_states:
+            return self.buffer.get_shapes(index - self.n_states)
+        n_bodies = self.buffer.poses.shape[1]
+        pose = np.fromfile(self.prefix + '.poses', np.float32, 3*n_bodies,
+                           offset=4*3*n_bodies*index)
+        return _posed_shapes(self.geometry, pose.reshape(n_bodies, 3).tolist())
+
+
+def _posed_shapes(geometry, pose):
+    """
+    Return the shapes of the geometry transformed to the pose, a list with
+    the (x, y, angle) of every body
+    """
+    shapes = []
+    for ibody, kind, params in geometry:
+        x, y, angle = pose[ibody]
+        c, s = math.cos(angle), math.sin(angle)
+        if kind == 'circle':
+            (px, py), radius = params
+            shapes.append(circleShape(
+                pos=(c*px - s*py + x, s*px + c*py + y), radius=radius))
+        else:
+            vertices = [(c*vx - s*vy + x, s*vx + c*vy + y)
+                        for vx, vy in params]
+            shapes.append(polygonShape(vertices=vertices))
+    return shapes
+
+
+def _map_array(filename, shape):
+    """
+    Memory-map a raw float32 file as an array of items of the given shape
+    """
+    n_items = os.path.getsize(filename) // (4*int(np.prod(shape)))
+    if n_items == 0:
+        return np.empty((0,) + shape, np.float32)
+    return np.memmap(filename, np.float32, 'r', shape=(n_items,) + shape)
+
+
+def interpolate(states, position, angles=False):
+    """
+    Return the states linearly interpolated at a fractional index, clamped to
+    the saved ones. With angles, the last column of every row is an angle.
+    """
+    position = min(max(position, 0), len(states) - 1)
+    index = int(position)
+    fraction = position - index
+    if fraction == 0:
+        return states[index]
+    before = states[index].astype(float)
+    after = states[index + 1].astype(float)
+    state = before + fraction*(after - before)
+    if angles:
+        turn = after[..., 2] - before[..., 2]
+        turn = (turn + math.pi) % (2*math.pi) - math.pi
+        state[..., 2] = before[..., 2] + fraction*turn
+    return state
+
+
+def _grow(array):
+    """
+    Return a copy of the array with twice the room along the first axis
+    """
+    grown = np.empty((2*len(array),) + array.shape[1:], array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def get_local_geometry(instance):
+    """
+    Return the fixture geometry of all bodies in body coordinates, as a list
+    of (body index, 'polygon', vertices) or (body index, 'circle',
+    (position, radius)) entries
+    """
+    geometry = []
+    for ibody, body in enumerate(instance.bodies):
+        for fixture in body:
+            shape = fixture.shape
+            if isinstance(shape, circleShape):
+                geometry.append((ibody, 'circle',
+                                 (tuple(shape.pos), shape.radius)))
+            else:
+                geometry.append((ibody, 'polygon',
+                                 [tuple(v) for v in shape.vertices]))
+    return geometry
 
 
 # Module function to get the shapes from bodies
@@ -116,9 +548,30 @@ def get_shapes(instance):
     shapes = []
     for body in instance.bodies:
         for fixture in body:
-            shapes.append( fixture.shape.get_transformed_shape(body) )
+            if isinstance(fixture.shape, chainShape):
+                # a chain is stored and drawn as its edges
+                shapes.extend(get_transformed_chain(fixture.shape, body))
+            else:
+                shapes.append( fixture.shape.get_transformed_shape(body) )
     return shapes
 
+# Conversion of shapes to plain parameters, for storing them in files
+def shape_to_params(shape):
+    if isinstance(shape, circleShape):
+        return 'circle', (tuple(shape.pos), shape.radius)
+    kind = 'edge' if isinstance(shape, edgeShape) else 'polygon'
+    return kind, [tuple(v) for v in shape.vertices]
+
+def params_to_shape(params):
+    kind, data = params
+    if kind == 'circle':
+        position, radius = data
+        return circleShape(pos=tuple(position), radius=radius)
+    vertices = [tuple(v) for v in data]
+    if kind == 'edge':
+        return edgeShape(vertices=vertices)
+    return polygonShape(vertices=vertices)
+
 # Helper functions to extract shapes in their correct positions
 #   Add them as methods to the shape classes for 'polymorphic' calls
 def get_transformed_edge(edge, body):
@@ -126,6 +579,10 @@ def get_transformed_edge(edge, body):
     return edgeShape(vertices=new_vertices)
 edgeShape.get_transformed_shape = get_transformed_edge
 
+def get_transformed_chain(chain, body):
+    vertices = [tuple(body.transform * v) for v in chain.vertices]
+    return [edgeShape(vertices=edge) for edge in zip(vertices, vertices[1:])]
+
 def get_transformed_polygon(polygon, body):
     new_vertices = [tuple(body.transform * v) for v in polygon.vertices]
     return polygonShape(vertices=new_vertices)
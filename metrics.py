@@ -0,0 +1,171 @@
+"""
+Lightweight instrumentation of the simulation and evolution
+Modules report into named timers (total seconds and number of calls) and
+counters of this module. Everything is off by default: timer() then returns a
+shared no-op context manager, timed() returns the function untouched and
+count() returns at once, so the instrumentation costs next to nothing.
+After enable(), the collected values can be taken with snapshot(), merged
+from worker processes with merge(), and exported as JSON lines or in the
+Prometheus text format. profile() wraps a block in cProfile.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+import cProfile
+import json
+import time
+
+enabled = False
+
+_timers = defaultdict(lambda: [0, 0.])   # name: [calls, seconds]
+_counters = defaultdict(int)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_timer = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        timer = _timers[self.name]
+        timer[0] += 1
+        timer[1] += time.perf_counter() - self.start
+        return False
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def timer(name):
+    """
+    Context manager adding the time spent in the block to the named timer
+    """
+    return _Timer(name) if enabled else _null_timer
+
+
+def timed(name, function):
+    """
+    Return the function wrapped to report every call to the named timer, or
+    the function itself when disabled. Meant for hot loops, where the wrapping
+    is decided once before the loop.
+    """
+    if not enabled:
+        return function
+    timer = _timers[name]
+    clock = time.perf_counter
+
+    def timed_function(*args, **kwargs):
+        start = clock()
+        result = function(*args, **kwargs)
+        timer[0] += 1
+        timer[1] += clock() - start
+        return result
+    return timed_function
+
+
+def count(name, n=1):
+    """
+    Add n to the named counter
+    """
+    if enabled:
+        _counters[name] += n
+
+
+def snapshot(reset=False):
+    """
+    Return the collected values as a dict with 'timers' ({name: {'calls',
+    'seconds'}}) and 'counters' ({name: value}), and clear them if reset
+    """
+    values = {'timers': {name: {'calls': calls, 'seconds': seconds}
+                         for name, (calls, seconds) in _timers.items()},
+              'counters': dict(_counters)}
+    if reset:
+        _timers.clear()
+        _counters.clear()
+    return values
+
+
+def merge(values):
+    """
+    Add a snapshot, e.g. one taken in a worker process, to the collected values
+    """
+    for name, timer in values['timers'].items():
+        _timers[name][0] += timer['calls']
+        _timers[name][1] += timer['seconds']
+    for name, value in values['counters'].items():
+        _counters[name] += value
+
+
+def write_jsonl(file, reset=True, **labels):
+    """
+    Append the collected values as one JSON line to an open file, with extra
+    labels such as the generation number
+    """
+    line = dict(labels)
+    line.update(snapshot(reset))
+    file.write(json.dumps(line) + '\n')
+    file.flush()
+
+
+def prometheus_text(prefix='biped_'):
+    """
+    Return the collected values in the Prometheus text exposition format
+    """
+    lines = []
+    values = snapshot()
+    for name, timer in sorted(values['timers'].items()):
+        metric = prefix + _metric_name(name)
+        lines.append('# TYPE %s_seconds counter' % metric)
+        lines.append('%s_seconds_total %r' % (metric, timer['seconds']))
+        lines.append('# TYPE %s_calls counter' % metric)
+        lines.append('%s_calls_total %d' % (metric, timer['calls']))
+    for name, value in sorted(values['counters'].items()):
+        metric = prefix + _metric_name(name)
+        lines.append('# TYPE %s counter' % metric)
+        lines.append('%s_total %r' % (metric, value))
+    return '\n'.join(lines) + '\n'
+
+
+def _metric_name(name):
+    return ''.join(c if c.isalnum() else '_' for c in name)
+
+
+@contextmanager
+def profile(filename):
+    """
+    Run the block under cProfile and dump the statistics to filename, to be
+    read with pstats or snakeviz
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(filename)
+
+
+def call_with_metrics(function, *args):
+    """
+    Call the function with metrics enabled and return its result together
+    with the snapshot of what it reported, for worker processes
+    """
+    enable()
+    snapshot(reset=True)
+    result = function(*args)
+    return result, snapshot(reset=True)
@@ -1,65 +1,286 @@
 
 import Box2D
 from Box2D.b2 import (world, polygonShape, circleShape, staticBody, dynamicBody)
+from collections import namedtuple
+import copy
+import logging
+import time
+import metrics
 from log_data import Data
+from termination import default_policy
+
+logger = logging.getLogger(__name__)
+
+# recording modes: nothing, only the tracker position, or every body shape
+RECORD_OFF = 'off'
+RECORD_TRACKER = 'tracker'
+RECORD_FULL = 'full'
+
+# integrator settings of a race: seconds of a simulation step (before the
+# speed factor), velocity and position iterations of the constraint solver,
+# and the Box2D steps each simulation step is split into
+Fidelity = namedtuple('Fidelity',
+                      ['time_step', 'vel_iters', 'pos_iters', 'substeps'])
+
+# screening: steps twice as long and a looser solver, about half the cost
+FIDELITY_LOW = Fidelity(1/30., 4, 1, 1)
+# the original settings, 60 Hz steps
+FIDELITY_DEFAULT = Fidelity(1/60., 6, 2, 1)
+# re-evaluation: 120 Hz substeps and a tighter solver
+FIDELITY_HIGH = Fidelity(1/60., 8, 3, 2)
+
+# step length the n_iter of races, their termination conditions and their
+# results count steps in, whatever the fidelity
+BASE_TIME_STEP = 1/60.
 
-min_move = 0.5
-max_stuck_time = 2
 
 class Simulation:
-    def __init__(self, terrain, biped, save=False):
+    def __init__(self, terrain, biped, record=RECORD_FULL, record_every=1,
+                 history=None, name='timeline'):
+        """
+        Arguments:
+            terrain:        Generated Terrain to race on
+            biped:          Bipedal to build and race
+            record:         One of RECORD_OFF, RECORD_TRACKER or RECORD_FULL
+            record_every:   Save the state only every n-th simulation step
+            history:        Data to record into (a new one if None), e.g. one
+                            streaming to a file
+            name:           Name of the timeline in the history
+        """
         self.terrain = terrain
         self.biped = biped
+        self.record = record
+        self.record_every = record_every
+        self.name = name
 
         # Create the world
-        self.sim_world = world(gravity=(0, -10), doSleep=True)
-        # Create the terrain (static ground body)
-        self.terrain.world = self.sim_world
-        self.terrain.build(self.sim_world)
+        with metrics.timer('sim.world'):
+            self.sim_world = world(gravity=(0, -10), doSleep=True)
+        # Create the terrain (static ground body) from its shared template
+        with metrics.timer('terrain.build'):
+            self.track = self.terrain.instantiate(self.sim_world)
+        # the replay shows the whole distance covered on an endless track
+        self.track.keep_shapes = record == RECORD_FULL
 
-        x0, y0 = self.terrain.get_spawn_pos()
-        self.biped.build(self.sim_world, x0, y0)
+        x0, y0 = self.track.get_spawn_pos()
+        with metrics.timer('biped.build'):
+            self.biped.build(self.sim_world, x0, y0)
 
         self.tracker = self.biped.tracker
         self.starting_position = self.tracker[0] #just x coordinate
 
         # Only init history after terrain was built
-        self.history = Data(self.terrain)
+        if record == RECORD_OFF:
+            self.history = None
+        elif history is not None:
+            self.history = history
+            if record == RECORD_FULL and not history.terrain:
+                history.set_terrain(self.track)
+        elif record == RECORD_TRACKER:
+            self.history = Data()
+        else:
+            self.history = Data(self.track)
+        if self.history is not None and name not in self.history.timelines:
+            # the timeline knows how many steps separate its states, for
+            # interpolating between them in replays
+            self.history.new_timeline(self.biped, name, record_every)
 
-    #returns dist covered and whether it is over (bool)
-    def run(self, n_iter=-1, speed=1.):
-        stuck_time = 0
+    #returns dist covered, whether it fell (bool) and the steps taken
+    def run(self, n_iter=-1, speed=1., termination=None, fidelity=None):
+        """
+        Race until the termination policy stops it, by default
+        termination.default_policy(n_iter). The reason is kept in .reason.
+        Arguments:
+            n_iter:         Maximum number of steps of BASE_TIME_STEP
+            speed:          Factor of the length of every step
+            termination:    Termination policy
+            fidelity:       Fidelity of the integration, FIDELITY_DEFAULT if
+                            None
+        The termination conditions and the steps returned count steps of
+        BASE_TIME_STEP too, so one policy stops races of every fidelity after
+        the same simulated time.
+        """
+        if fidelity is None:
+            fidelity = FIDELITY_DEFAULT
+        if termination is None:
+            termination = default_policy(n_iter)
+        termination.start(self.biped)
 
-        time_step = speed/60. #60 Hz by default
-        vel_iters, pos_iters = 6, 2 #apparently good
+        time_step = speed*fidelity.time_step
+        vel_iters, pos_iters = fidelity.vel_iters, fidelity.pos_iters
+        scale = step_scale(fidelity)
         i = 0
+        save = self.save_function()
+        # decided once here, so disabled metrics cost nothing in the loop
+        step = metrics.timed('sim.step', substepper(self.sim_world, fidelity))
+        if save:
+            save = metrics.timed('data.save_state', save)
+            # replays count steps of BASE_TIME_STEP, so the states saved by a
+            # coarser fidelity lie further apart
+            self.history.timelines[self.name].every = self.record_every*scale
+        stream = self.track.update if self.track.streaming else None
         while True:
-            self.sim_world.Step(time_step, vel_iters, pos_iters)
-            if self.history: self.history.save_state(self.biped)
-
-            #check if we're moving forward
-            position = self.tracker[0]
-            distance = position - self.starting_position
-            if distance < min_move:
-                stuck_time += time_step
-            else:
-                stuck_time = 0
-
-            # if we're stuck for too long finish the loop
-            if stuck_time > max_stuck_time:
-                print("Stuck in one place")
-                return distance, True, n_iter
+            step(time_step, vel_iters, pos_iters)
+            if save and i % self.record_every == 0: save(self.biped, self.name)
+
+            #check how far we moved forward
+            distance = self.tracker[0] - self.starting_position
+            if stream:
+                stream(self.tracker[0], self.tracker[0])
 
             i+= 1
-            if n_iter>0 and i > n_iter:
-                print("Reached max time", n_iter*time_step, "s")
-                return distance, False, n_iter
+            if termination.check(self.biped, distance, i*scale, time_step):
+                metrics.count('sim.races')
+                metrics.count('sim.steps', i)
+                self.reason = termination.reason
+                logger.debug('%s after %d steps (%.1f s), distance %.2f',
+                             self.reason, i, i*time_step, distance)
+                if stream and save and self.record == RECORD_FULL:
+                    self.record_streamed_terrain()
+                return distance, termination.fell, base_steps(i, fidelity)
+
+    def record_streamed_terrain(self):
+        """
+        Replace the terrain of the history, the chunks of an endless track
+        present when it was created, with all of the track generated during
+        the race, unless another race recorded a longer one
+        """
+        shapes = self.track.get_shapes()
+        if len(shapes) > len(self.history.terrain or []):
+            self.history.terrain = shapes
+
+    def save_function(self):
+        """
+        Return the function saving a state for the recording mode, or None
+        """
+        if self.history is None:
+            return None
+        if self.record == RECORD_TRACKER:
+            return self.history.save_tracker
+        return self.history.save_state
+
+
+class BatchSimulation:
+    """
+    Race many bipeds at once in a single world
+    The terrain is instantiated once and every biped gets its own collision group,
+    so the bipeds only touch the terrain and never each other. All of them
+    are stepped together, and each one is retired (its bodies destroyed) as
+    soon as its termination policy stops it.
+    Nothing is recorded, this is meant for bulk fitness evaluation. Contacts
+    are solved in a different order than in separate worlds, so scores can
+    differ slightly from the ones of a single Simulation.
+    """
+    def __init__(self, terrain, bipeds):
+        """
+        Arguments:
+            terrain:    Generated Terrain to race on
+            bipeds:     List of Bipedals to build and race
+        """
+        self.terrain = terrain
+        self.bipeds = bipeds
+
+        with metrics.timer('sim.world'):
+            self.sim_world = world(gravity=(0, -10), doSleep=True)
+        with metrics.timer('terrain.build'):
+            self.track = self.terrain.instantiate(self.sim_world)
+
+        x0, y0 = self.track.get_spawn_pos()
+        with metrics.timer('biped.build'):
+            for group, biped in enumerate(self.bipeds, 1):
+                biped.build(self.sim_world, x0, y0, group)
+        self.starting_positions = [biped.tracker[0] for biped in bipeds]
+
+    def run(self, n_iter=-1, speed=1., termination=None, fidelity=None):
+        """
+        Return the (distance, fell, steps) of every biped, in order. Every
+        biped gets its own copy of the termination policy, by default
+        termination.default_policy(n_iter). Why and when (in seconds of wall
+        time from the start) each biped stopped is kept in .reasons and
+        .wall_times. The arguments are the ones of Simulation.run.
+        """
+        if fidelity is None:
+            fidelity = FIDELITY_DEFAULT
+        if termination is None:
+            termination = default_policy(n_iter)
+        start = time.perf_counter()
+        policies = [copy.deepcopy(termination) for biped in self.bipeds]
+        for biped, policy in zip(self.bipeds, policies):
+            policy.start(biped)
+
+        time_step = speed*fidelity.time_step
+        vel_iters, pos_iters = fidelity.vel_iters, fidelity.pos_iters
+        scale = step_scale(fidelity)
+        results = [None]*len(self.bipeds)
+        self.reasons = [None]*len(self.bipeds)
+        self.wall_times = [None]*len(self.bipeds)
+        racing = list(range(len(self.bipeds)))
+        i = 0
+        step = metrics.timed('sim.step', substepper(self.sim_world, fidelity))
+        stream = self.track.update if self.track.streaming else None
+        while racing:
+            step(time_step, vel_iters, pos_iters)
+            i += 1
+            if stream:
+                positions = [self.bipeds[k].tracker[0] for k in racing]
+                stream(min(positions), max(positions))
+            still_racing = []
+            for k in racing:
+                biped = self.bipeds[k]
+                distance = biped.tracker[0] - self.starting_positions[k]
+                if policies[k].check(biped, distance, i*scale, time_step):
+                    results[k] = (distance, policies[k].fell,
+                                  base_steps(i, fidelity))
+                    self.reasons[k] = policies[k].reason
+                    self.wall_times[k] = time.perf_counter() - start
+                    metrics.count('sim.races')
+                    metrics.count('sim.steps', i)
+                    self.retire(biped)
+                else:
+                    still_racing.append(k)
+            racing = still_racing
+        return results
+
+    def retire(self, biped):
+        """
+        Remove the bodies (and with them the joints) of a finished biped
+        """
+        for body in biped.bodies:
+            self.sim_world.DestroyBody(body)
+        biped.bodies = []
+        biped.tracker = None
+
+
+def substepper(sim_world, fidelity):
+    """
+    Return the function advancing the world by one simulation step, split
+    into the substeps of the fidelity
+    """
+    if fidelity.substeps == 1:
+        return sim_world.Step
+    substeps = range(fidelity.substeps)
+    def step(time_step, vel_iters, pos_iters):
+        time_step /= fidelity.substeps
+        for k in substeps:
+            sim_world.Step(time_step, vel_iters, pos_iters)
+    return step
+
 
-            if self.tracker[1] < 0:
+def step_scale(fidelity):
+    """
+    Return how many steps of BASE_TIME_STEP a step of the fidelity lasts,
+    the integer 1 for 60 Hz fidelities
+    """
+    if fidelity.time_step == BASE_TIME_STEP:
+        return 1
+    return fidelity.time_step / BASE_TIME_STEP
 
-                print("Fell off the cliff")
-                return distance, True, n_iter
 
-        #return final distance
-        print("Normal")
-        return (distance, False, n_iter)
+def base_steps(steps, fidelity):
+    """
+    Return steps of the fidelity counted in steps of BASE_TIME_STEP
+    """
+    scale = step_scale(fidelity)
+    if scale == 1:
+        return steps
+    return int(round(steps * scale))
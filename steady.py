@@ -0,0 +1,107 @@
+"""
+Steady-state evolution that never waits for stragglers.
+Instead of breeding a whole generation once every biped of the previous one
+has finished racing, a fixed number of evaluations is kept running in a
+process pool. Whenever one finishes, the individual is inserted into the
+Population (replacing the worst one if it is fitter) and a new child is bred
+by tournament selection and sent to the free worker, so the workers stay busy
+however much the race lengths vary.
+Run as "python steady.py" to evolve with the settings below.
+"""
+
+from concurrent.futures import (ProcessPoolExecutor, wait, FIRST_COMPLETED)
+import logging
+import os
+import random
+
+from algo import Population as Pop
+from evaluate import (evaluate, cache_key, Evaluation, CACHED)
+from fitness_cache import FitnessCache
+
+logger = logging.getLogger(__name__)
+
+size_pop = 10
+# total number of individuals raced, the same work as evolve.py's 50
+# generations of 10
+num_evaluations = 500
+
+
+def run_steady_state(pool, terrain_params, n_evaluations=num_evaluations,
+                     workers=None, n_iter=1e4, cache=None, event_log=None):
+    """
+    Evolve the pool by steady-state replacement and return it, sorted by
+    fitness (fittest last)
+    Arguments:
+        pool:           Population whose (unevaluated) individuals start the
+                        run, its size is kept throughout
+        terrain_params: (length, roughness, seed) of the track
+        n_evaluations:  Number of individuals to race in total
+        workers:        Number of worker processes, all cores if None
+        n_iter:         Maximum number of simulation steps per biped
+        cache:          FitnessCache consulted before racing
+        event_log:      EventLog to record every evaluation in
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    size = len(pool.population)
+    # the initial individuals are raced first, children are bred only from
+    # evaluated ones
+    backlog = pool.population
+    pool.population = []
+    running = {}
+    done = 0
+
+    def next_individual():
+        if backlog:
+            return backlog.pop()
+        return pool.breed()
+
+    def finish(c, result):
+        c.fitness = result.score
+        pool.insert(c, size)
+        if event_log:
+            event_log.log(evaluation=done, name=c.name, gene=list(c.gene),
+                          **result._asdict())
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        submitted = 0
+        while done < n_evaluations:
+            # keep two tasks per worker queued, so none of them idles, but
+            # breed only once some individuals have been evaluated
+            while (submitted < n_evaluations and len(running) < 2*workers
+                   and (backlog or pool.population)):
+                c = next_individual()
+                submitted += 1
+                key = cache_key(c.gene, terrain_params, n_iter)
+                cached = cache.get(key) if cache else None
+                if cached:
+                    finish(c, Evaluation(*cached, CACHED, 0.))
+                    done += 1
+                    continue
+                future = executor.submit(evaluate, list(c.gene),
+                                         terrain_params, n_iter)
+                running[future] = (c, key)
+
+            if not running:
+                continue
+            finished, pending = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                c, key = running.pop(future)
+                result = future.result()
+                if cache:
+                    cache.put(key, result)
+                finish(c, result)
+                done += 1
+                if done % size == 0:
+                    logger.info('%d evaluations, best %.2f', done,
+                                pool.population[-1].fitness)
+    return pool
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    pool = run_steady_state(Pop(size_pop),
+                            (400, 4, random.randrange(2**31)),
+                            cache=FitnessCache())
+    best = pool.population[-1]
+    print('Best: %.2f %s' % (best.fitness, best.gene))
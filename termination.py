@@ -0,0 +1,209 @@
+"""
+Stop conditions of a race
+A race is checked after every simulation step by a termination policy, a
+Condition or several of them combined with AnyOf. Each condition keeps its own
+per-race state, reset by start(), and check() tells whether the biped should
+stop now. The triggered condition gives the reason and whether it counts as a
+fall. default_policy(n_iter) reproduces the original hardcoded behaviour of
+Simulation.run.
+Conditions are plain objects, so they can be deep-copied for every biped of a
+batch and pickled to worker processes; their repr lists their parameters and
+is used as part of the fitness cache key.
+"""
+
+from collections import deque
+import math
+
+
+class Condition:
+    """
+    Base of all stop conditions
+    """
+    reason = 'Stopped'
+    fell = False
+
+    def __repr__(self):
+        params = ', '.join('%s=%r' % (key, value)
+                           for key, value in sorted(vars(self).items())
+                           if not key.startswith('_'))
+        return '%s(%s)' % (type(self).__name__, params)
+
+    def start(self, biped):
+        """
+        Reset the state at the start of a race
+        """
+        pass
+
+    def check(self, biped, distance, step, time_step):
+        """
+        Return True if the race has to stop
+        Arguments:
+            biped:      Bipedal racing, with its bodies and tracker
+            distance:   Distance covered from the start
+            step:       Number of steps of sim.BASE_TIME_STEP simulated,
+                        several at once for coarse fidelities
+            time_step:  Seconds simulated since the last check
+        """
+        return False
+
+
+class AnyOf(Condition):
+    """
+    Stop as soon as any of the conditions applies, checked in order
+    """
+    def __init__(self, *conditions):
+        self.conditions = list(conditions)
+        self._triggered = None
+
+    @property
+    def reason(self):
+        return self._triggered.reason if self._triggered else Condition.reason
+
+    @property
+    def fell(self):
+        return self._triggered.fell if self._triggered else False
+
+    def start(self, biped):
+        self._triggered = None
+        for condition in self.conditions:
+            condition.start(biped)
+
+    def check(self, biped, distance, step, time_step):
+        for condition in self.conditions:
+            if condition.check(biped, distance, step, time_step):
+                self._triggered = condition
+                return True
+        return False
+
+
+class Stuck(Condition):
+    """
+    Stop when the biped stays closer than min_move to the start for longer
+    than max_time seconds
+    """
+    reason = 'Stuck in one place'
+    fell = True
+
+    def __init__(self, min_move=0.5, max_time=2):
+        self.min_move = min_move
+        self.max_time = max_time
+        self._stuck_time = 0
+
+    def start(self, biped):
+        self._stuck_time = 0
+
+    def check(self, biped, distance, step, time_step):
+        if distance < self.min_move:
+            self._stuck_time += time_step
+        else:
+            self._stuck_time = 0
+        return self._stuck_time > self.max_time
+
+
+class MaxSteps(Condition):
+    """
+    Stop after n_iter steps, never if n_iter is not positive
+    """
+    reason = 'Reached max time'
+
+    def __init__(self, n_iter):
+        self.n_iter = n_iter
+
+    def check(self, biped, distance, step, time_step):
+        return self.n_iter > 0 and step > self.n_iter
+
+
+class FellOff(Condition):
+    """
+    Stop when the tracked body drops below the given height
+    """
+    reason = 'Fell off the cliff'
+    fell = True
+
+    def __init__(self, height=0):
+        self.height = height
+
+    def check(self, biped, distance, step, time_step):
+        return biped.tracker[1] < self.height
+
+
+class NoProgress(Condition):
+    """
+    Stop when the biped moved forward less than min_progress during the last
+    window seconds, wherever it is on the track
+    """
+    reason = 'No forward progress'
+    fell = True
+
+    def __init__(self, window=2., min_progress=0.5):
+        self.window = window
+        self.min_progress = min_progress
+        self._positions = deque()
+
+    def start(self, biped):
+        self._positions = deque()
+
+    def check(self, biped, distance, step, time_step):
+        positions = self._positions
+        positions.append(distance)
+        if len(positions) * time_step <= self.window:
+            return False
+        return distance - positions.popleft() < self.min_progress
+
+
+class Tilted(Condition):
+    """
+    Stop when a body of the biped turns more than max_angle radians from its
+    starting orientation. The torso, neck and head (bodies 0 to 2 of a
+    Bipedal) have a fixed rotation, so the default body is the right leg.
+    Its hip joint lets it swing up to 0.3*pi either way, strides stay well
+    within max_angle and a leg pushed past it has toppled backwards.
+    """
+    reason = 'Tilted over'
+    fell = True
+
+    def __init__(self, max_angle=0.25*math.pi, body=3):
+        self.max_angle = max_angle
+        self.body = body
+        self._start_angle = 0
+
+    def start(self, biped):
+        self._start_angle = biped.bodies[self.body].angle
+
+    def check(self, biped, distance, step, time_step):
+        angle = biped.bodies[self.body].angle - self._start_angle
+        return abs(angle) > self.max_angle
+
+
+class CannotBeat(Condition):
+    """
+    Stop when the biped could not reach the target distance before n_iter
+    steps even moving at max_speed meters per second from now on, e.g. with
+    the target set to the k-th best distance of the generation so far. The
+    stopped biped scores less than the target, so the best k keep their rank.
+    """
+    reason = 'Cannot beat target'
+
+    def __init__(self, target, max_speed, n_iter):
+        self.target = target
+        self.max_speed = max_speed
+        self.n_iter = n_iter
+        self._elapsed = 0
+
+    def start(self, biped):
+        self._elapsed = 0
+
+    def check(self, biped, distance, step, time_step):
+        # a check may cover several steps, the seconds per step are
+        # measured along the way
+        self._elapsed += time_step
+        remaining = (self.n_iter - step) * self._elapsed / step
+        return distance + remaining * self.max_speed < self.target
+
+
+def default_policy(n_iter=-1):
+    """
+    Policy of the original Simulation.run: stuck near the start for 2 seconds,
+    reached n_iter steps, or fell below the ground
+    """
+    return AnyOf(Stuck(), MaxSteps(n_iter), FellOff())
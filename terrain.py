@@ -2,6 +2,16 @@
 Module for creating the racing tracks each of which is an instance of class Track.
 Allows to create a flat block, series of slopes or a continuous track with
 parametrised roughness. Class method build the track as a series of box2d polygons.
+Tracks are generated deterministically from a seed, and the generated geometry
+is cached by (length, roughness, seed), so a track raced by a whole generation
+or by many worker processes is computed only once per process. Simulations put
+the track into their world from a TerrainTemplate, a single static body with
+the segments compiled once as fixtures, leaving the Terrain itself untouched.
+With shape=CHAIN the track is instead a single chain shape along the top of
+the segments, smooth for the contacts and much cheaper for long tracks.
+A Terrain of length None is endless: its segments are generated from the seed
+a chunk at a time ahead of the bipeds, and the chunks far behind them are
+destroyed, so open-ended races keep a bounded world.
 TODO:
     Write class docstrings!
     Make the spawnpoint just above the first track segment
@@ -10,35 +20,113 @@ TODO:
 
 import Box2D  # The main library
 # Box2D.b2 maps Box2D.b2Vec2 to vec2 (and so on)
-from Box2D.b2 import (world, polygonShape, circleShape, staticBody, dynamicBody, vec2)
+from Box2D.b2 import (world, polygonShape, circleShape, chainShape, staticBody, dynamicBody, vec2)
+import logging
 import random
-from datetime import datetime
 import math
+from collections import deque
+from functools import lru_cache
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# number of distinct (length, roughness, seed) tracks kept by the cache
+CACHE_SIZE = 64
+
+# shapes of the track in the world
+BOXES = 'boxes'   # a box per segment
+CHAIN = 'chain'   # one chain along the surface
+# corners of neighbouring segments closer than this are merged in a chain
+CHAIN_TOLERANCE = .5
+
+# endless tracks: meters generated ahead of the leading biped and kept behind
+# the last one, and segments per static body (the unit created or destroyed)
+STREAM_AHEAD = 200
+STREAM_BEHIND = 50
+STREAM_CHUNK = 16
+# endless tracks never go below this height, so FellOff(0) still only means
+# falling
+STREAM_FLOOR = 5
 
 class Terrain:
-    def __init__(self, length, roughness=0, seed=None):
+    def __init__(self, length, roughness=0, seed=None, shape=BOXES):
+        """
+        Arguments:
+            length:     Length of the track in meters, None for an endless
+                        track generated while the bipeds race on it
+            roughness:  0 for flat, 1 for slopes, more for a rough track
+            seed:       Seed of the track, a random one is drawn (and kept in
+                        .seed) if None, so every track can be reproduced
+            shape:      BOXES or CHAIN, how the track is put into the world
+        """
+        if shape not in (BOXES, CHAIN):
+            raise ValueError('unknown terrain shape %r' % shape)
+        if length is None and shape != BOXES:
+            raise ValueError('endless tracks are only built from boxes')
         self.length = length
         self.roughness = roughness
+        if seed is None:
+            seed = random.SystemRandom().randrange(2**31)
         self.seed = seed
+        self.shape = shape
         self.generated = False
         self.generate()
 
+    @property
+    def params(self):
+        """
+        (length, roughness, seed) which reproduce this track, followed by the
+        shape unless it is BOXES
+        """
+        if self.shape == BOXES:
+            return (self.length, self.roughness, self.seed)
+        return (self.length, self.roughness, self.seed, self.shape)
+
+    @property
+    def endless(self):
+        return self.length is None
+
     def generate(self):
-        if self.seed:
-            random.seed(seed)
-        else:
-            random.seed(datetime.now())
+        metrics.count('terrain.generate')
+        if self.endless:
+            # segments are generated by every StreamingTrack on the go
+            self.spawn = STREAM_SPAWN
+            self.generated = True
+            return
+        (self.n_segments, self.seg_lengths, self.seg_angles,
+         self.seg_positions, self.spawn) = generate(self.length,
+                                                    self.roughness, self.seed)
+        self.generated = True
 
-        if self.roughness == 0:
-            self.gen_flat()
-        elif self.roughness == 1:
-            self.gen_slopes()
-        else:
-            self.gen_rough(self.roughness-1)
+    @property
+    def template(self):
+        """TerrainTemplate of this track, compiled once and shared"""
+        return compile_template(*self.params)
+
+    def instantiate(self, world):
+        """
+        Create the track in the world from the template, without changing
+        this Terrain, so it can be shared between threads and simulations.
+        Return the TerrainInstance holding the created bodies, or the
+        StreamingTrack of an endless track.
+        """
+        if not self.generated:
+            return None
+        if self.endless:
+            return StreamingTrack(world, self.roughness, self.seed)
+        return self.template.instantiate(world)
 
     def build(self, world):
+        """
+        Create the track as one static body per segment and keep them in
+        .bodies. Prefer instantiate(), which neither changes the Terrain nor
+        creates a body per segment.
+        """
         if not self.generated:
             return None
+        if self.shape == CHAIN or self.endless:
+            self.bodies = self.instantiate(world).bodies
+            return self.length
 
         start = 0
         self.bodies = []
@@ -53,46 +141,268 @@ class Terrain:
 
         return self.length
 
+    def get_spawn_pos(self):
+        if not self.generated:
+            logger.error('track not generated for some reason')
+            return None
+        return self.spawn
+
 
-    def gen_flat(self):
-        self.n_segments = 1
-        self.seg_lengths = [self.length]
-        self.seg_angles = [0]
-        self.seg_positions = [(0,3)]
-        self.spawn = (5, 10)
-        self.generated = True
+class TerrainTemplate:
+    """
+    Track geometry compiled once into the world coordinates of the corners of
+    every segment, ready to be put into any number of worlds as a single
+    static body with one polygon fixture per segment. Templates are immutable.
+    """
+    def __init__(self, polygons, spawn):
+        """
+        Arguments:
+            polygons:   Tuple of the vertex tuples of every segment
+            spawn:      Spawn position of the track
+        """
+        self.polygons = polygons
+        self.spawn = spawn
 
-    def gen_slopes(self):
-        seg_len = 30
-        nn = self.length/seg_len
-        self.n_segments = nn
-        self.seg_lengths = [seg_len for x in range(nn)]
-        self.seg_angles = [0.15 for x in range(nn)]
-        self.seg_positions = [(0.9*seg_len*x,3) for x in range(nn)]
-        self.spawn = (5, 10)
-        self.generated = True
+    def instantiate(self, world):
+        body = world.CreateStaticBody(position=(0, 0))
+        for vertices in self.polygons:
+            body.CreatePolygonFixture(vertices=vertices)
+        return TerrainInstance([body], self.spawn)
 
-    def gen_rough(self, roughness):
-        SEG_LENGTH = 15
-        nn = self.length//SEG_LENGTH
-        self.n_segments = nn
-        self.seg_lengths = [0]*nn
-        self.seg_angles = [0]*nn
-        self.seg_positions = [0]*nn
-        prev_pos = vec2(0, 20) # starting coordinates
-        for i in range(nn):
-            self.seg_lengths[i] = SEG_LENGTH
-            angle = random.uniform(-0.1, 0.1)*roughness
-            self.seg_angles[i] = angle
-            length = SEG_LENGTH * math.cos(angle)
-            height = SEG_LENGTH * math.sin(angle)
-            self.seg_positions[i] = prev_pos + (.5*length, .5*height)
-            prev_pos += (length, height)
-        self.spawn = (SEG_LENGTH, 30)
-        self.generated = True
+
+class ChainTemplate:
+    """
+    Track compiled into the vertices of its surface, put into a world as a
+    single static body with one chain shape. The chain gives smooth contacts
+    between its edges and costs the broadphase a handful of proxies instead
+    of one per segment.
+    """
+    def __init__(self, vertices, spawn):
+        """
+        Arguments:
+            vertices:   Tuple of the surface vertices, from left to right
+            spawn:      Spawn position of the track
+        """
+        self.vertices = vertices
+        self.spawn = spawn
+
+    def instantiate(self, world):
+        body = world.CreateStaticBody(position=(0, 0))
+        # a track too short for a single segment has no surface, its body
+        # stays empty like the one of a TerrainTemplate
+        if self.vertices:
+            # body.CreateChainFixture would close the chain into a loop
+            body.CreateFixture(shape=chainShape(vertices_chain=self.vertices))
+        return TerrainInstance([body], self.spawn)
+
+
+class TerrainInstance:
+    """
+    Track created in one world: its static bodies and spawn position, with
+    the interface of a built Terrain
+    """
+    streaming = False
+
+    def __init__(self, bodies, spawn):
+        self.bodies = bodies
+        self.spawn = spawn
 
     def get_spawn_pos(self):
-        if not self.generated:
-            print('Error, track not generated for some reason')
-            return None
         return self.spawn
+
+
+class StreamingTrack:
+    """
+    Endless track created in one world, a chunk of segments (one static body)
+    at a time. update() is called with the positions of the last and the
+    leading biped as they race, it generates the chunks coming within
+    STREAM_AHEAD of the leader and destroys the ones further than
+    STREAM_BEHIND behind the last biped. The segments come from a private
+    random generator, so every StreamingTrack of a seed is the same track.
+    """
+    streaming = True
+
+    def __init__(self, world, roughness, seed):
+        """
+        Arguments:
+            world:      Box2D world to create the track in
+            roughness:  0 or 1 for flat, more for a rough track
+            seed:       Seed of the track
+        """
+        self.world = world
+        self.segments = gen_endless(max(roughness - 1, 0),
+                                    random.Random(seed))
+        self.chunks = deque()   # (body, right end, polygons)
+        self.front = 0.
+        self.spawn = STREAM_SPAWN
+        # geometry of the destroyed chunks, only kept when keep_shapes is set
+        self.keep_shapes = False
+        self.passed = []
+        self.update(self.spawn[0], self.spawn[0])
+
+    @property
+    def bodies(self):
+        return [body for body, end, polygons in self.chunks]
+
+    def get_spawn_pos(self):
+        return self.spawn
+
+    def update(self, back, front):
+        """
+        Generate the track ahead of front and destroy it behind back (the x
+        coordinates of the leading and last bipeds)
+        """
+        while self.front < front + STREAM_AHEAD:
+            self.add_chunk()
+        while self.chunks and self.chunks[0][1] < back - STREAM_BEHIND:
+            body, end, polygons = self.chunks.popleft()
+            self.world.DestroyBody(body)
+            if self.keep_shapes:
+                self.passed.extend(polygons)
+            metrics.count('terrain.chunks_destroyed')
+
+    def add_chunk(self):
+        body = self.world.CreateStaticBody(position=(0, 0))
+        polygons = []
+        for i in range(STREAM_CHUNK):
+            polygon = segment_polygon(*next(self.segments))
+            body.CreatePolygonFixture(vertices=polygon)
+            polygons.append(polygon)
+        self.front = max(x for x, y in polygons[-1])
+        self.chunks.append((body, self.front, polygons))
+        metrics.count('terrain.chunks_created')
+
+    def get_shapes(self):
+        """
+        Return the polygonShapes of the whole track generated so far, which
+        requires keep_shapes to have been set before the first chunk was
+        destroyed
+        """
+        polygons = self.passed + [polygon for body, end, polygons in
+                                  self.chunks for polygon in polygons]
+        return [polygonShape(vertices=polygon) for polygon in polygons]
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def compile_template(length, roughness, seed, shape=BOXES):
+    """
+    Return the TerrainTemplate, or the ChainTemplate for shape=CHAIN, of a
+    track, cached like generate()
+    """
+    n_segments, seg_lengths, seg_angles, seg_positions, spawn = \
+            generate(length, roughness, seed)
+    polygons = [segment_polygon(seg_lengths[i], seg_angles[i],
+                                seg_positions[i])
+                for i in range(n_segments)]
+    if shape == CHAIN:
+        return ChainTemplate(surface(polygons), spawn)
+    return TerrainTemplate(tuple(polygons), spawn)
+
+
+def segment_polygon(seg_length, angle, position):
+    """
+    Return the world coordinates of the corners of a segment box, bottom left
+    first and counterclockwise
+    """
+    half_length, half_height = seg_length/2., .5
+    c, s = math.cos(angle), math.sin(angle)
+    x0, y0 = position
+    return tuple((x0 + c*x - s*y, y0 + s*x + c*y)
+                 for x, y in [(-half_length, -half_height),
+                              (half_length, -half_height),
+                              (half_length, half_height),
+                              (-half_length, half_height)])
+
+
+def surface(polygons):
+    """
+    Return the vertices of the line along the tops of the segment boxes, as
+    given by compile_template. Corners of neighbouring segments which nearly
+    meet are merged at their middle, where the next segment starts under the
+    previous one (the slopes) the line drops straight down onto it. No
+    segments give no vertices.
+    """
+    if not polygons:
+        return ()
+    vertices = [polygons[0][3]]
+    for box, next_box in zip(polygons, polygons[1:]):
+        (x0, y0), (x1, y1) = box[2], next_box[3]
+        if math.hypot(x1 - x0, y1 - y0) < CHAIN_TOLERANCE:
+            vertices.append(((x0 + x1)/2., (y0 + y1)/2.))
+        elif x1 < x0:
+            (left_x, left_y), (right_x, right_y) = next_box[3], next_box[2]
+            slope = (right_y - left_y) / (right_x - left_x)
+            vertices.append((x0, y0))
+            vertices.append((x0, left_y + slope*(x0 - left_x)))
+        else:
+            vertices.append((x0, y0))
+            vertices.append((x1, y1))
+    vertices.append(polygons[-1][2])
+    return tuple(vertices)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def generate(length, roughness, seed):
+    """
+    Generate the geometry of a track, return the tuple (n_segments,
+    seg_lengths, seg_angles, seg_positions, spawn). The segments are drawn
+    from a private random generator, so the same arguments always give the
+    same track and the global random state is left alone. Results are cached,
+    so they are immutable tuples which all Terrains of a track share.
+    """
+    rng = random.Random(seed)
+    if roughness == 0:
+        return gen_flat(length)
+    elif roughness == 1:
+        return gen_slopes(length)
+    else:
+        return gen_rough(length, roughness-1, rng)
+
+def gen_flat(length):
+    return 1, (length,), (0,), ((0,3),), (5, 10)
+
+def gen_slopes(length):
+    seg_len = 30
+    nn = length//seg_len
+    seg_lengths = tuple(seg_len for x in range(nn))
+    seg_angles = tuple(0.15 for x in range(nn))
+    seg_positions = tuple((0.9*seg_len*x,3) for x in range(nn))
+    return nn, seg_lengths, seg_angles, seg_positions, (5, 10)
+
+def gen_rough(length, roughness, rng):
+    SEG_LENGTH = 15
+    nn = length//SEG_LENGTH
+    seg_lengths = [0]*nn
+    seg_angles = [0]*nn
+    seg_positions = [0]*nn
+    prev_pos = vec2(0, 20) # starting coordinates
+    for i in range(nn):
+        seg_lengths[i] = SEG_LENGTH
+        angle = rng.uniform(-0.1, 0.1)*roughness
+        seg_angles[i] = angle
+        seg_len = SEG_LENGTH * math.cos(angle)
+        height = SEG_LENGTH * math.sin(angle)
+        seg_positions[i] = tuple(prev_pos + (.5*seg_len, .5*height))
+        prev_pos += (seg_len, height)
+    spawn = (SEG_LENGTH, 30)
+    return (nn, tuple(seg_lengths), tuple(seg_angles), tuple(seg_positions),
+            spawn)
+
+STREAM_SPAWN = (15, 30)
+
+def gen_endless(roughness, rng):
+    """
+    Generate the (seg_length, angle, position) of the segments of an endless
+    track one by one, like gen_rough, except that a segment which would go
+    below STREAM_FLOOR goes up by the same angle instead
+    """
+    SEG_LENGTH = 15
+    prev_pos = vec2(0, 20) # starting coordinates
+    while True:
+        angle = rng.uniform(-0.1, 0.1)*roughness
+        if prev_pos[1] + SEG_LENGTH*math.sin(angle) < STREAM_FLOOR:
+            angle = -angle
+        seg_len = SEG_LENGTH * math.cos(angle)
+        height = SEG_LENGTH * math.sin(angle)
+        yield SEG_LENGTH, angle, tuple(prev_pos + (.5*seg_len, .5*height))
+        prev_pos += (seg_len, height)
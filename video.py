@@ -0,0 +1,234 @@
+"""
+Encoders of rendered frames
+Replays drawn offscreen by view.export are written frame by frame into one of
+these writers, so no frame is kept in memory once it is encoded:
+    APNGWriter  animated PNG, lossless and needing nothing but the standard
+                library, chosen for the .png and .apng extensions
+    FFmpegWriter raw frames piped into an ffmpeg subprocess, for every other
+                extension (.mp4, .webm, .gif, ...)
+Both take pygame Surfaces of the size given when opening them.
+Videos rendered in segments, by parallel workers, are joined with concatenate.
+"""
+
+import os
+import shutil
+import struct
+import subprocess
+import zlib
+
+import numpy as np
+import pygame
+
+# ffmpeg executable used by FFmpegWriter
+FFMPEG = 'ffmpeg'
+# zlib level of the APNG frames, 1 is fastest, 9 smallest
+PNG_COMPRESSION = 6
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def open_writer(filename, size, fps):
+    """
+    Return the writer for the extension of the filename
+    Arguments:
+        filename:   File to encode the frames into
+        size:       (width, height) of the frames in pixels
+        fps:        Frames per second of the video
+    """
+    if filename.lower().endswith(('.png', '.apng')):
+        return APNGWriter(filename, size, fps)
+    return FFmpegWriter(filename, size, fps)
+
+
+def concatenate(segments, filename):
+    """
+    Join video files of the same size and format, in order, into one
+    Arguments:
+        segments:   Files to join, animated PNGs or files ffmpeg can read
+        filename:   File to write, with the extension of the segments
+    """
+    if filename.lower().endswith(('.png', '.apng')):
+        _concatenate_apng(segments, filename)
+        return
+    if shutil.which(FFMPEG) is None:
+        raise RuntimeError('%s not found, install it or export to an '
+                           'animated .png' % FFMPEG)
+    list_file = filename + '.segments'
+    with open(list_file, 'w') as listing:
+        for segment in segments:
+            listing.write("file '%s'\n" % os.path.abspath(segment))
+    command = [FFMPEG, '-y', '-loglevel', 'error', '-f', 'concat',
+               '-safe', '0', '-i', list_file]
+    if not filename.lower().endswith('.gif'):
+        # the segments are joined without encoding them again
+        command += ['-c', 'copy']
+    try:
+        subprocess.run(command + [filename], check=True)
+    finally:
+        os.remove(list_file)
+
+
+def _concatenate_apng(segments, filename):
+    writer = None
+    for segment in segments:
+        frame = None
+        for kind, data in _read_chunks(segment):
+            if kind == b'IHDR' and writer is None:
+                size = struct.unpack('>II', data[:8])
+            elif kind == b'fcTL':
+                if writer is None:
+                    writer = APNGWriter(filename, size,
+                                        struct.unpack('>H', data[22:24])[0])
+                if frame is not None:
+                    writer.write_compressed(b''.join(frame))
+                frame = []
+            elif kind == b'IDAT':
+                frame.append(data)
+            elif kind == b'fdAT':
+                # without the sequence number, renumbered by the writer
+                frame.append(data[4:])
+        if frame is not None:
+            writer.write_compressed(b''.join(frame))
+    if writer:
+        writer.close()
+
+
+def _read_chunks(filename):
+    """
+    Yield the (kind, data) of every chunk of a PNG file
+    """
+    with open(filename, 'rb') as png:
+        if png.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+            raise ValueError('%s is not a PNG file' % filename)
+        while True:
+            header = png.read(8)
+            if len(header) < 8:
+                return
+            length, kind = struct.unpack('>I4s', header)
+            data = png.read(length)
+            png.read(4)   # CRC
+            yield kind, data
+
+
+def surface_to_array(surface):
+    """
+    Return the pixels of a Surface as an RGB array of shape (height, width, 3)
+    """
+    width, height = surface.get_size()
+    data = pygame.image.tobytes(surface, 'RGB')
+    return np.frombuffer(data, np.uint8).reshape(height, width, 3)
+
+
+class FFmpegWriter:
+    """
+    Pipe raw RGB frames into ffmpeg, which encodes them into the file, in a
+    format chosen from its extension
+    """
+    def __init__(self, filename, size, fps):
+        if shutil.which(FFMPEG) is None:
+            raise RuntimeError('%s not found, install it or export to an '
+                               'animated .png' % FFMPEG)
+        self.filename = filename
+        self.size = tuple(size)
+        command = [FFMPEG, '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                   '-s', '%dx%d' % self.size, '-r', str(fps), '-i', '-']
+        if not filename.lower().endswith('.gif'):
+            # the pixel format every player understands
+            command += ['-pix_fmt', 'yuv420p']
+        self.process = subprocess.Popen(command + [filename],
+                                        stdin=subprocess.PIPE)
+        self.n_frames = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def write(self, surface):
+        self.process.stdin.write(pygame.image.tobytes(surface, 'RGB'))
+        self.n_frames += 1
+
+    def close(self):
+        if self.process.stdin.closed:
+            return
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError('%s failed to encode %s'
+                               % (FFMPEG, self.filename))
+
+
+class APNGWriter:
+    """
+    Write the frames into an animated PNG, each compressed as it comes
+    The number of frames is only known at the end, the animation control
+    chunk is then rewritten in place.
+    """
+    def __init__(self, filename, size, fps):
+        self.filename = filename
+        self.size = tuple(size)
+        self.fps = int(round(fps))
+        self.file = open(filename, 'wb')
+        self.n_frames = 0
+        self.sequence = 0
+        self.file.write(PNG_SIGNATURE)
+        width, height = self.size
+        # 8 bit RGB, no interlacing
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height,
+                                         8, 2, 0, 0, 0))
+        self.actl_offset = self.file.tell()
+        self._chunk(b'acTL', struct.pack('>II', 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def write(self, surface):
+        self.write_compressed(compress_frame(surface))
+
+    def write_compressed(self, data):
+        """
+        Add a frame already compressed by compress_frame
+        """
+        width, height = self.size
+        self._chunk(b'fcTL', struct.pack('>IIIIIHHBB', self.sequence,
+                                         width, height, 0, 0,
+                                         1, self.fps, 0, 0))
+        self.sequence += 1
+        if self.n_frames == 0:
+            # the first frame is also the still image of plain PNG viewers
+            self._chunk(b'IDAT', data)
+        else:
+            self._chunk(b'fdAT', struct.pack('>I', self.sequence) + data)
+            self.sequence += 1
+        self.n_frames += 1
+
+    def close(self):
+        if self.file.closed:
+            return
+        self._chunk(b'IEND', b'')
+        self.file.seek(self.actl_offset)
+        # frames, and 0 plays for looping forever
+        self._chunk(b'acTL', struct.pack('>II', self.n_frames, 0))
+        self.file.close()
+
+    def _chunk(self, kind, data):
+        self.file.write(struct.pack('>I', len(data)) + kind + data +
+                        struct.pack('>I', zlib.crc32(kind + data)))
+
+
+def compress_frame(surface):
+    """
+    Return the zlib-compressed scanlines of a Surface, as stored in PNG
+    """
+    pixels = surface_to_array(surface)
+    height, width = pixels.shape[:2]
+    # every scanline starts with its filter type, 0 for none
+    rows = np.zeros((height, 1 + 3*width), np.uint8)
+    rows[:, 1:] = pixels.reshape(height, 3*width)
+    return zlib.compress(rows.tobytes(), PNG_COMPRESSION)
@@ -3,17 +3,39 @@ Simple visualisation using pygame.
 start_game() initialises the pygame screen and clock
 run(history, list_of_timelines, speed) draws the subsequent physics frames of a
     saved history for a list of timelines.
+export(history, list_of_timelines, filename) renders the frames offscreen,
+    without a display and as fast as possible, into a video file.
+export_parallel(history_dir, filename) does the same with the frames split
+    between worker processes.
+Frames are drawn by a Renderer, which rasterizes the terrain once into tiles
+and transforms the vehicle shapes with NumPy. Only what the camera sees is
+drawn, and its level of detail can be lowered for large replays.
+Run as "python view.py <history dir> [speed]" to replay a history stored by
+Data.write_to_file or streamed during evolution, add "--export <file>" to
+encode it into a video instead.
 """
 
 import pygame
 from pygame.locals import (QUIT, KEYDOWN, K_ESCAPE, K_RETURN)
 from pygame.color import Color
+import argparse
+from bisect import (bisect_left, bisect_right)
+from collections import OrderedDict
+from itertools import repeat
+import math
+import os
 import random
 
+import numpy as np
+
 import Box2D  # The main library
 # Box2D.b2 maps Box2D.b2Vec2 to vec2 (and so on)
 from Box2D.b2 import (world, polygonShape, circleShape, edgeShape, shape, vec2)
 
+from log_data import (Data, shape_to_params, interpolate)
+from evaluate import (WorkerPool, pool_size, executor)
+import video
+
 # --- constants ---
 # Box2D deals with meters, but we want to display pixels,
 # so define a conversion factor:
@@ -28,6 +50,24 @@ def_color = (0, 0, 0, 255) # black, opaque
 col_names = ['red', 'green', 'blue', 'orange', 'yellow', 'pink', 'azure']
 obj_colors = [Color(name) for name in col_names]
 
+# world position (meters from the bottom left corner) the camera keeps the
+# first timeline at
+CAMERA = (40, 20)
+# width in pixels of the pre-rasterized terrain tiles, and how many are kept
+TILE_WIDTH = 1024
+MAX_TILES = 16
+# low level of detail: bipeds further than this from the camera (meters) are
+# drawn as markers of this radius (pixels), the others without outlines
+LOD_DISTANCE = 25
+MARKER_RADIUS = 4
+# ghost races: colormap from the worst to the best fitness (viridis), and
+# number of batches of similar fitness, each drawn in one color on a layer
+# blended onto the frame with the given opacity (0 to 255)
+GHOST_COLORMAP = [(68, 1, 84), (59, 82, 139), (33, 145, 140), (94, 201, 98),
+                  (253, 231, 37)]
+GHOST_BATCHES = 8
+GHOST_ALPHA = 110
+
 
 def start():
     pygame.display.init()
@@ -84,9 +124,31 @@ edgeShape.draw = draw_edgeShape
 
 
 def draw_history(history, timelines, index):
+    """
+    Draw the given saved state of the timelines on the screen, through a
+    Renderer kept for the history as long as it is drawn
+    """
+    global _last_renderer
+    renderer = _last_renderer
+    if renderer is None or renderer.history is not history or \
+            renderer.names != list(timelines) or renderer.surface is not screen:
+        renderer = _last_renderer = Renderer(history, timelines, screen)
+    renderer.draw(index*history.timelines[timelines[0]].every)
+
+    # Update the screen
+    pygame.display.flip()
+
+_last_renderer = None
+
+
+def draw_history_shapes(history, timelines, index):
+    """
+    Draw the timelines with their Box2D shapes rebuilt for every frame, as
+    draw_history used to, for comparing renderers
+    """
     screen.fill(bkg_color)
     first = timelines[0]
-    tracker = history.timelines[first].tracker_states[index]
+    tracker = vec2(*history.timelines[first].tracker_states[index].tolist())
     shift = vec2(40,20) - tracker
     drawing_func(history.terrain, shift=shift, color=def_color)
     for i, time in enumerate(reversed(timelines)):
@@ -106,8 +168,418 @@ def drawing_func(objects, shift, color):
             obj.draw(shift, def_color, width=2)
 
 
-def run(history, timelines, speed=1.):
-    draw_history(history, timelines, 0)
+class ShapeArrays:
+    """
+    Shapes of a vehicle as NumPy arrays of their vertices in body coordinates,
+    which are transformed to a pose and to pixels for all shapes at once
+    """
+    def __init__(self, geometry):
+        """
+        Arguments:
+            geometry:   List of (body index, kind, params) entries, as in
+                        Timeline.geometry
+        """
+        vertices, bodies, centres, circle_bodies = [], [], [], []
+        extents = {}
+        # (kind, first vertex, end vertex) or ('circle', centre, radius) of
+        # every shape, in the order they are drawn
+        self.items = []
+        for ibody, kind, params in geometry:
+            if kind == 'circle':
+                position, radius = params
+                self.items.append((kind, len(centres), radius))
+                centres.append(position)
+                circle_bodies.append(ibody)
+                extent = math.hypot(*position) + radius
+            else:
+                self.items.append((kind, len(vertices),
+                                   len(vertices) + len(params)))
+                vertices.extend(params)
+                bodies.extend([ibody]*len(params))
+                extent = max(math.hypot(*vertex) for vertex in params)
+            extents[ibody] = max(extents.get(ibody, 0), extent)
+        self.vertices = np.array(vertices, float).reshape(-1, 2)
+        self.bodies = np.array(bodies, int)
+        self.centres = np.array(centres, float).reshape(-1, 2)
+        self.circle_bodies = np.array(circle_bodies, int)
+        # distance of the furthest point of every body from its origin
+        self.extents = np.zeros(max(extents, default=-1) + 1)
+        for ibody, extent in extents.items():
+            self.extents[ibody] = extent
+
+    def bounds(self, poses):
+        """
+        Return a (left, bottom, right, top) box around the shapes at the poses
+        """
+        poses = np.asarray(poses, float)[:len(self.extents)]
+        x, y = poses[:, 0], poses[:, 1]
+        return ((x - self.extents).min(), (y - self.extents).min(),
+                (x + self.extents).max(), (y + self.extents).max())
+
+    def to_pixels(self, points, bodies, poses, shift, ppm, height):
+        """
+        Return the points, given in the coordinates of their bodies, as a
+        list of integer pixel positions on a surface of the given height
+        """
+        x, y, angle = np.asarray(poses, float)[bodies].T
+        c, s = np.cos(angle), np.sin(angle)
+        px = c*points[:, 0] - s*points[:, 1] + x + shift[0]
+        py = s*points[:, 0] + c*points[:, 1] + y + shift[1]
+        pixels = np.empty((len(points), 2), int)
+        pixels[:, 0] = px*ppm
+        pixels[:, 1] = height - (py*ppm).astype(int)
+        return pixels.tolist()
+
+    def pixels(self, poses, shift, ppm, height):
+        """
+        Return the pixel positions of all vertices and all circle centres at
+        the poses (x, y, angle of every body)
+        """
+        return (self.to_pixels(self.vertices, self.bodies, poses, shift, ppm,
+                               height),
+                self.to_pixels(self.centres, self.circle_bodies, poses, shift,
+                               ppm, height))
+
+    def draw(self, surface, poses, shift, ppm, color, outlines=True):
+        """
+        Draw the shapes at the poses (x, y, angle of every body) filled with
+        the color and, unless outlines is False, outlined like drawing_func
+        """
+        vertices, centres = self.pixels(poses, shift, ppm,
+                                        surface.get_height())
+        draw_items(surface, self.items, vertices, centres, ppm, color,
+                   outlines)
+
+
+def draw_items(surface, items, vertices, centres, ppm, color, outlines=True):
+    """
+    Draw ShapeArrays items from the pixel positions of their vertices and
+    centres
+    """
+    for kind, start, end in items:
+        if kind == 'circle':
+            radius = int(end*ppm)
+            pygame.draw.circle(surface, color, centres[start], radius)
+            if outlines:
+                pygame.draw.circle(surface, def_color, centres[start],
+                                   radius, 2)
+        elif kind == 'edge':
+            pygame.draw.line(surface, color, *vertices[start:end])
+            if outlines:
+                pygame.draw.line(surface, def_color, *vertices[start:end],
+                                 width=2)
+        else:
+            pygame.draw.polygon(surface, color, vertices[start:end])
+            if outlines:
+                pygame.draw.polygon(surface, def_color, vertices[start:end],
+                                    2)
+
+
+class TerrainTiles:
+    """
+    Terrain rasterized into tiles TILE_WIDTH pixels wide, spanning the height
+    of the whole terrain. A tile is drawn the first time it is seen and then
+    only blitted; the MAX_TILES last used ones are kept.
+    """
+    def __init__(self, shapes, ppm):
+        """
+        Arguments:
+            shapes:     Terrain shapes in world coordinates
+            ppm:        Pixels per meter
+        """
+        self.ppm = ppm
+        geometry = [(0, ) + shape_to_params(shape) for shape in shapes]
+        # sorted by left end, the shapes crossing a tile are found by bisection
+        ranges = [(min(x for x, y in _points(kind, params)),
+                   max(x for x, y in _points(kind, params)))
+                  for ibody, kind, params in geometry]
+        order = sorted(range(len(geometry)), key=lambda i: ranges[i][0])
+        self.geometry = [geometry[i] for i in order]
+        self.lefts = [ranges[i][0] for i in order]
+        self.rights = [ranges[i][1] for i in order]
+        self.max_width = max([right - left for left, right in ranges],
+                             default=0)
+        self.tiles = OrderedDict()
+        if not self.geometry:
+            return
+        points = np.array([point for ibody, kind, params in self.geometry
+                           for point in _points(kind, params)], float)
+        # a meter of margin keeps the outlines inside the tiles
+        self.x_min, self.y_min = points.min(axis=0) - 1
+        x_max, self.y_max = points.max(axis=0) + 1
+        self.height = int(math.ceil((self.y_max - self.y_min)*ppm))
+        self.n_tiles = int(math.ceil((x_max - self.x_min)*ppm / TILE_WIDTH))
+
+    def draw(self, surface, shift):
+        """
+        Blit the tiles visible with the camera shift onto the surface
+        """
+        if not self.geometry:
+            return
+        tile_meters = TILE_WIDTH / self.ppm
+        left = -shift[0] - self.x_min
+        first = max(int(left // tile_meters), 0)
+        last = min(int((left + surface.get_width()/self.ppm) // tile_meters),
+                   self.n_tiles - 1)
+        top = surface.get_height() - int((self.y_max + shift[1])*self.ppm)
+        for i in range(first, last + 1):
+            x = int((self.x_min + i*tile_meters + shift[0])*self.ppm)
+            surface.blit(self.tile(i), (x, top))
+
+    def tile(self, i):
+        if i in self.tiles:
+            self.tiles.move_to_end(i)
+            return self.tiles[i]
+        tile_meters = TILE_WIDTH / self.ppm
+        x0 = self.x_min + i*tile_meters
+        geometry = self.visible(x0 - 1, x0 + tile_meters + 1)
+        tile = pygame.Surface((TILE_WIDTH, self.height))
+        tile.fill(bkg_color)
+        shift = (-x0, self.height/self.ppm - self.y_max)
+        ShapeArrays(geometry).draw(tile, [(0, 0, 0)], shift, self.ppm,
+                                   def_color)
+        if pygame.display.get_surface() is not None:
+            # the pixel format of the screen blits fastest
+            tile = tile.convert()
+        self.tiles[i] = tile
+        if len(self.tiles) > MAX_TILES:
+            self.tiles.popitem(last=False)
+        return tile
+
+
+    def visible(self, left, right):
+        """
+        Return the geometry of the shapes crossing the x range
+        """
+        first = bisect_left(self.lefts, left - self.max_width)
+        last = bisect_right(self.lefts, right)
+        return [self.geometry[i] for i in range(first, last)
+                if self.rights[i] >= left]
+
+
+def _points(kind, params):
+    if kind == 'circle':
+        (x, y), radius = params
+        return [(x - radius, y - radius), (x + radius, y + radius)]
+    return params
+
+
+class Renderer:
+    """
+    Draws the frames of a history onto a surface, the display or an offscreen
+    one, with the camera following the first timeline. Frames are given by
+    simulation step, fractional ones included, and the poses of timelines
+    saved only every few steps are interpolated. Vehicles of the other
+    timelines which stopped earlier stay at their last pose.
+    Only the terrain tiles in view are blitted and vehicles whose bounding box
+    is out of view are skipped. With lod, vehicles far from the camera are
+    drawn as markers and the others without outlines.
+    """
+    def __init__(self, history, timelines, surface, lod=False):
+        """
+        Arguments:
+            history:    Data holding the timelines
+            timelines:  Names of the timelines to draw
+            surface:    pygame Surface to draw on; the scale follows its
+                        width, SCREEN_WIDTH pixels show the same view as the
+                        window
+            lod:        Lower the level of detail, see LOD_DISTANCE
+        """
+        self.history = history
+        self.names = list(timelines)
+        self.surface = surface
+        self.lod = lod
+        self.ppm = PPM * surface.get_width() / SCREEN_WIDTH
+        self.timelines = [history.timelines[name] for name in timelines]
+        self.shapes = [ShapeArrays(timeline.geometry)
+                       for timeline in self.timelines]
+        self.terrain = TerrainTiles(history.terrain or [], self.ppm)
+
+    def draw(self, step):
+        """
+        Draw the frame of a simulation step
+        """
+        self.surface.fill(bkg_color)
+        tracker = self.timelines[0].tracker_at(step).tolist()
+        shift = (CAMERA[0] - tracker[0], CAMERA[1] - tracker[1])
+        self.terrain.draw(self.surface, shift)
+        width, height = self.surface.get_size()
+        left, bottom = -shift[0], -shift[1]
+        right, top = left + width/self.ppm, bottom + height/self.ppm
+        for i, (timeline, shapes) in enumerate(reversed(list(zip(
+                self.timelines, self.shapes)))):
+            if len(timeline.vehicle_states) == 0:
+                continue
+            poses = timeline.pose_at(step)
+            x0, y0, x1, y1 = shapes.bounds(poses)
+            if x1 < left or x0 > right or y1 < bottom or y0 > top:
+                continue
+            color = obj_colors[i % len(obj_colors)]
+            if self.lod and abs((x0 + x1)/2. - tracker[0]) > LOD_DISTANCE:
+                centre = [int(((x0 + x1)/2. + shift[0])*self.ppm),
+                          height - int(((y0 + y1)/2. + shift[1])*self.ppm)]
+                pygame.draw.circle(self.surface, color, centre, MARKER_RADIUS)
+                continue
+            shapes.draw(self.surface, poses, shift, self.ppm, color,
+                        outlines=not self.lod)
+
+
+class GhostRenderer(Renderer):
+    """
+    Draws a whole generation at once as translucent ghosts colored by fitness,
+    with the camera following the fittest. The poses of all vehicles are
+    stacked into one array up front, padded with the last pose of the ones
+    which stopped earlier, and their shapes are transformed together for
+    every frame. They are drawn without outlines in GHOST_BATCHES batches of
+    similar fitness, each on a layer blended onto the frame in the rectangle
+    it covers, the fittest batch last. Timelines without poses, recorded
+    with RECORD_TRACKER, can lead the camera but have no ghost.
+    """
+    def __init__(self, history, timelines, surface, fitness=None):
+        """
+        Arguments:
+            history:    Data holding the timelines
+            timelines:  Names of the timelines to draw
+            surface:    pygame Surface to draw on
+            fitness:    Dict of the fitness of every timeline, the distance
+                        covered by its tracker if None
+        """
+        if fitness is None:
+            fitness = {name: distance_covered(history.timelines[name])
+                       for name in timelines}
+        timelines = sorted(timelines, key=lambda name: -fitness[name])
+        Renderer.__init__(self, history, timelines, surface)
+        posed = [k for k, timeline in enumerate(self.timelines)
+                 if len(timeline.vehicle_states)]
+        self.ghosts = [self.timelines[k] for k in posed]
+
+        # all vehicles as one, with their bodies numbered one after another
+        geometry, starts, extents, n_items = [], [], [], []
+        n_bodies = 0
+        for k in posed:
+            timeline, shapes = self.timelines[k], self.shapes[k]
+            starts.append(n_bodies)
+            geometry.extend((ibody + n_bodies, kind, params)
+                            for ibody, kind, params in timeline.geometry)
+            n_items.append(len(timeline.geometry))
+            body_extents = np.zeros(timeline.vehicle_states.shape[1])
+            body_extents[:len(shapes.extents)] = shapes.extents
+            extents.append(body_extents)
+            n_bodies += len(body_extents)
+        self.all_shapes = ShapeArrays(geometry)
+        self.starts = np.array(starts, int)
+        self.extents = np.concatenate(extents) if extents else np.zeros(0)
+        ends = np.cumsum(n_items)
+        self.items = [self.all_shapes.items[end - n:end]
+                      for n, end in zip(n_items, ends)]
+        self.every = self.ghosts[0].every if self.ghosts else 1
+        if all(timeline.every == self.every for timeline in self.ghosts):
+            length = max([len(timeline.vehicle_states)
+                          for timeline in self.ghosts], default=0)
+            self.poses = np.empty((length, n_bodies, 3), np.float32)
+            for start, timeline in zip(starts, self.ghosts):
+                states = timeline.vehicle_states
+                end = start + states.shape[1]
+                self.poses[:len(states), start:end] = states
+                self.poses[len(states):, start:end] = states[-1]
+        else:
+            self.poses = None
+
+        scores = np.array([fitness[timelines[k]] for k in posed], float)
+        low, high = (scores.min(), scores.max()) if len(scores) else (0., 0.)
+        span = (high - low) or 1.
+        batch = np.minimum(((scores - low) / span *
+                            GHOST_BATCHES).astype(int), GHOST_BATCHES - 1)
+        self.batches = [np.flatnonzero(batch == b).tolist()
+                        for b in range(GHOST_BATCHES)]
+        self.colors = [colormap((b + .5) / GHOST_BATCHES)
+                       for b in range(GHOST_BATCHES)]
+        self.layer = pygame.Surface(surface.get_size())
+        self.layer.set_colorkey(bkg_color[:3])
+        self.layer.set_alpha(GHOST_ALPHA)
+
+    def draw(self, step):
+        self.surface.fill(bkg_color)
+        tracker = self.timelines[0].tracker_at(step).tolist()
+        shift = (CAMERA[0] - tracker[0], CAMERA[1] - tracker[1])
+        self.terrain.draw(self.surface, shift)
+        if not self.ghosts:
+            return
+
+        if self.poses is not None:
+            poses = interpolate(self.poses, step / self.every, True)
+        else:
+            poses = np.concatenate([timeline.pose_at(step)
+                                    for timeline in self.ghosts])
+        width, height = self.surface.get_size()
+        vertices, centres = self.all_shapes.pixels(poses, shift, self.ppm,
+                                                   height)
+        # bounding boxes of all vehicles in pixels, for culling the ones out
+        # of view
+        x = (np.asarray(poses[:, 0], float) + shift[0])*self.ppm
+        y = height - (np.asarray(poses[:, 1], float) + shift[1])*self.ppm
+        extents = self.extents*self.ppm
+        left = np.minimum.reduceat(x - extents, self.starts)
+        right = np.maximum.reduceat(x + extents, self.starts)
+        top = np.minimum.reduceat(y - extents, self.starts)
+        bottom = np.maximum.reduceat(y + extents, self.starts)
+        visible = ((right >= 0) & (left <= width) &
+                   (bottom >= 0) & (top <= height))
+        for batch, color in zip(self.batches, self.colors):
+            batch = [k for k in batch if visible[k]]
+            if not batch:
+                continue
+            x0 = max(int(min(left[k] for k in batch)) - 2, 0)
+            y0 = max(int(min(top[k] for k in batch)) - 2, 0)
+            x1 = min(int(max(right[k] for k in batch)) + 3, width)
+            y1 = min(int(max(bottom[k] for k in batch)) + 3, height)
+            area = pygame.Rect(x0, y0, x1 - x0, y1 - y0)
+            self.layer.fill(bkg_color, area)
+            for k in batch:
+                draw_items(self.layer, self.items[k], vertices, centres,
+                           self.ppm, color, outlines=False)
+            self.surface.blit(self.layer, area.topleft, area)
+
+
+def colormap(value, colors=GHOST_COLORMAP):
+    """
+    Return the color at value, from 0 to 1, of the colormap interpolated
+    linearly between the colors
+    """
+    value = min(max(value, 0.), 1.) * (len(colors) - 1)
+    i = min(int(value), len(colors) - 2)
+    fraction = value - i
+    return tuple(int(a + fraction*(b - a))
+                 for a, b in zip(colors[i], colors[i + 1]))
+
+
+def distance_covered(timeline):
+    trackers = timeline.tracker_states
+    return float(trackers[-1][0] - trackers[0][0]) if len(trackers) else 0.
+
+
+def make_renderer(history, timelines, surface, lod=False, ghosts=False,
+                  fitness=None):
+    """
+    Return a GhostRenderer coloring the ghosts by fitness if ghosts, else a
+    Renderer
+    """
+    if ghosts:
+        return GhostRenderer(history, timelines, surface, fitness)
+    return Renderer(history, timelines, surface, lod)
+
+
+def run(history, timelines, speed=1., lod=False, ghosts=False, fitness=None):
+    """
+    Play the timelines in the window, speed simulation steps per frame after
+    RETURN is pressed; any positive speed works, also for histories saved
+    only every few steps. See Renderer for lod, with ghosts all timelines are
+    overlaid by a GhostRenderer, colored by the fitness dict if given.
+    """
+    renderer = make_renderer(history, timelines, screen, lod, ghosts,
+                             fitness)
+    renderer.draw(0)
+    pygame.display.flip()
 
     start = False
     while not start:
@@ -119,8 +591,8 @@ def run(history, timelines, speed=1.):
             return
 
     running = True
-    n_states = history.max_length
-    istate = 0
+    n_steps = history.max_steps
+    step = 0.
 
     while running:
         pygame.display.update()
@@ -129,13 +601,14 @@ def run(history, timelines, speed=1.):
                 # The user closed the window or pressed escape
                 running = False
 
-        istate += int(speed)
-        if istate >= n_states:
+        step += speed
+        if step >= n_steps:
             running = False
             continue
 
         try:
-            draw_history(history, timelines, istate)
+            renderer.draw(step)
+            pygame.display.flip()
             clock.tick(TARGET_FPS)
         except(IndexError):
             print('Run out of bounds for first biped, finishing')
@@ -144,6 +617,135 @@ def run(history, timelines, speed=1.):
     #pygame.quit()
 
 
+def replay(filename, speed=1., lod=False, ghosts=False):
+    """
+    Replay all timelines of a history stored in a directory
+    """
+    history = Data()
+    history.read_from_file(filename)
+    start()
+    run(history, list(history.timelines), speed, lod, ghosts)
+
+
+def export(history, timelines, filename, every=1, size=None, fps=TARGET_FPS,
+           first=0, last=None, lod=False, ghosts=False):
+    """
+    Render the frames offscreen, without a display and without waiting for
+    the clock, and encode them into a video file (see video.open_writer)
+    Arguments:
+        history:    Data holding the timelines
+        timelines:  Names of the timelines to draw
+        filename:   Video file, an animated .png or anything ffmpeg writes
+        every:      Render only every n-th simulation step, skipping the
+                    others
+        size:       (width, height) of the video, the window size if None
+        fps:        Frames per second of the video
+        first:      First simulation step to render
+        last:       Step after the last one to render, all if None
+        lod:        Lower the level of detail, see Renderer
+        ghosts:     Overlay the timelines as ghosts, see GhostRenderer
+    Return the number of frames written.
+    """
+    size = tuple(size or (SCREEN_WIDTH, SCREEN_HEIGHT))
+    renderer = make_renderer(history, timelines, pygame.Surface(size), lod,
+                             ghosts)
+    if last is None:
+        last = history.max_steps
+    with video.open_writer(filename, size, fps) as writer:
+        for step in range(first, last, every):
+            renderer.draw(step)
+            writer.write(renderer.surface)
+        return writer.n_frames
+
+
+def export_file(filename, output, **options):
+    """
+    Export all timelines of a history stored in a directory, see export
+    """
+    history = Data()
+    history.read_from_file(filename)
+    return export(history, list(history.timelines), output, **options)
+
+
+def export_parallel(filename, output, workers=None, every=1, size=None,
+                    fps=TARGET_FPS, lod=False, ghosts=False):
+    """
+    Export all timelines of a history stored in a directory, like export_file,
+    with the frames split into consecutive segments. Every worker process
+    memory-maps the history, renders and encodes its segment, and the
+    segments are then joined in order into the output.
+    Arguments:
+        filename:   Directory of the history
+        output:     Video file, see export
+        workers:    Number of worker processes, None uses every core, or a
+                    evaluate.WorkerPool to render in
+        every, size, fps, lod, ghosts: See export
+    Return the number of frames written.
+    """
+    history = Data()
+    history.read_from_file(filename)
+    indices = range(0, history.max_steps or 0, every)
+    n_segments = min(pool_size(workers), len(indices))
+    if n_segments <= 1:
+        return export(history, list(history.timelines), output, every, size,
+                      fps, lod=lod, ghosts=ghosts)
+
+    # segments start at frames of the whole video, so they keep its spacing
+    bounds = [indices[len(indices)*k // n_segments]
+              for k in range(n_segments)] + [history.max_steps]
+    base, extension = os.path.splitext(output)
+    segments = ['%s.part%03d%s' % (base, k, extension)
+                for k in range(n_segments)]
+    try:
+        if not isinstance(workers, WorkerPool):
+            workers = n_segments
+        with executor(workers) as pool:
+            counts = list(pool.map(_export_segment, repeat(filename),
+                                   segments, bounds[:-1], bounds[1:],
+                                   repeat(every), repeat(size), repeat(fps),
+                                   repeat(lod), repeat(ghosts)))
+        video.concatenate(segments, output)
+    finally:
+        for segment in segments:
+            if os.path.exists(segment):
+                os.remove(segment)
+    return sum(counts)
+
+
+def _export_segment(filename, output, first, last, every, size, fps, lod,
+                    ghosts):
+    return export_file(filename, output, every=every, size=size, fps=fps,
+                       first=first, last=last, lod=lod, ghosts=ghosts)
+
+
 def quit_game():
     pygame.display.quit()
 pygame.quit()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a stored history.')
+    parser.add_argument('history', help='directory of the history')
+    parser.add_argument('speed', type=float, nargs='?', default=1.)
+    parser.add_argument('--export', metavar='FILE',
+                        help='render offscreen into this video file instead')
+    parser.add_argument('--every', type=int, default=1,
+                        help='export only every n-th simulation step')
+    parser.add_argument('--size', default=None,
+                        help='WIDTHxHEIGHT of the exported video')
+    parser.add_argument('--fps', type=int, default=TARGET_FPS)
+    parser.add_argument('--lod', action='store_true',
+                        help='draw distant bipeds as markers, no outlines')
+    parser.add_argument('--ghosts', action='store_true',
+                        help='overlay all bipeds colored by distance covered')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes rendering the export, all cores if '
+                             'not given')
+    args = parser.parse_args()
+    if args.export:
+        size = tuple(int(x) for x in args.size.split('x')) \
+                if args.size else None
+        export_parallel(args.history, args.export, args.workers,
+                        every=args.every, size=size, fps=args.fps,
+                        lod=args.lod, ghosts=args.ghosts)
+    else:
+        replay(args.history, args.speed, args.lod, args.ghosts)